@@ -45,6 +45,7 @@ def palt2(press, press_0):
     return alt
 
 
-print(palt(189, 209))
-print(palt2(189, 209))
+if __name__ == '__main__':
+    print(palt(189, 209))
+    print(palt2(189, 209))
 
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" altacc
+
+This is the one command for the BSR AltAcc software
+
+    altacc read         download flight data ( proread )
+    altacc reduce       reduce flight data to reports ( produce )
+    altacc calibrate    calibrate an AltAcc ( probate )
+    altacc clear        clear the flight data memory ( proclear )
+    altacc query        query a flight archive ( proquery )
+    altacc archive      pack flight data files into an archive ( proarch )
+    altacc sim          simulate AltAcc units on ptys ( prosim )
+    altacc bench        time the hot paths ( probench )
+
+followed by the options of that program, e.g. altacc read --help.  Only sys
+is imported to start and the program for the subcommand is imported when it
+runs, from its compiled .pyc, and it imports the rest ( asyncio, logging,
+matplotlib ... ) lazily as it is needed ( see prodata.lazy_import ).
+"""
+
+import sys
+
+VERSION = "1.25c"
+
+COMMANDS = {
+    'read': ('proread', 'download flight data from one or more AltAccs'),
+    'reduce': ('produce', 'reduce flight data to reports'),
+    'calibrate': ('probate', 'calibrate an AltAcc'),
+    'clear': ('proclear', 'clear the AltAcc flight data memory'),
+    'query': ('proquery', 'filter, rank and total the flights in an archive'),
+    'archive': ('proarch', 'pack flight data files into an archive and back'),
+    'sim': ('prosim', 'simulate AltAcc units for testing without the hardware'),
+    'bench': ('probench', 'time the hot paths and compare with the last run'),
+}
+
+
+def usage(fp):
+    print(f"usage: altacc {{{','.join(COMMANDS)}}} ...", file=fp)
+    print(file=fp)
+    print(f"AltAcc software (v{VERSION})", file=fp)
+    print(file=fp)
+    for name, (module, desc) in COMMANDS.items():
+        print(f"  {name:12}{desc} ( {module} )", file=fp)
+    print(file=fp)
+    print("altacc COMMAND --help for the options of a command", file=fp)
+
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if not argv or argv[0] in ('-h', '--help'):
+        usage(sys.stdout if argv else sys.stderr)
+        return 0 if argv else 2
+
+    if argv[0] == '--version':
+        print(f'v{VERSION}')
+        return 0
+
+    if argv[0] not in COMMANDS:
+        usage(sys.stderr)
+        print(f"altacc: error: unknown command {argv[0]}", file=sys.stderr)
+        return 2
+
+    module = __import__(COMMANDS[argv[0]][0])
+
+    return module.main(argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
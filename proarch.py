@@ -0,0 +1,526 @@
+""" proarch
+
+This program packs AltAcc flight data files into a single columnar archive
+and gets them back out again.
+
+Archive file layout ( little endian )
+
+    magic, format, count          archive_header
+    count x entry                 flight id, 32 byte dump header, 4 byte trailer
+    count x 4080 bytes            accelerometer column
+    count x 4080 bytes            pressure column
+    per index key                 count sorted key bytes then count uint32 rows
+
+The entries are sorted by flight id so the id index is the table itself.
+The other indexes ( firmware Version, BSFlags mode and apogee pressure )
+are stored sorted so a query is a bisect and reads only the index bytes,
+and the columns are only touched for the flights a query actually wants.
+
+Reductions of the archived flights are kept next to the archive in a JSON
+file ( ARCHIVE.reductions ) along with the calibration file and values each
+was reduced with.  When a unit's calibration file changes only its flights
+are reduced again, across a process pool, and when only the pressure
+calibration changed only the pressure altitudes are recomputed.
+"""
+
+import os
+import sys
+import mmap
+import glob
+import json
+import struct
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import prodata
+import proreduce
+from proreduce import flight_events
+
+logging = prodata.lazy_import('logging')
+
+VERSION = "1.25c"
+
+ARCHIVE_MAGIC = b'ALTACCAR'
+ARCHIVE_FORMAT = 1
+ID_SIZE = 32
+SAMPLES = prodata.DATA_SIZE // 2
+
+archive_header = struct.Struct("<8sHI")
+entry_format = struct.Struct(f"<{ID_SIZE}s{prodata.header_format.size}s{prodata.trailer_format.size}s")
+
+INDEX_KEYS = ('Version', 'mode', 'apogee_pre')
+
+REDUCTIONS_EXT = '.reductions'
+ACC_PARAMS = ('Slope',)                 # change these and the flight is reduced again
+PRESSURE_PARAMS = ('OffBP', 'GainBP')   # change only these and only the altitudes are
+
+
+def index_keys(flight):
+    """ the index key values for a flight """
+
+    events = flight_events(flight)
+    return {'Version': flight.Version, 'mode': events.mode, 'apogee_pre': events.apogee_pre}
+
+
+def _dump(header, trailer):
+    """ an AltAccDump with no flight data from the header and trailer bytes """
+
+    return prodata.AltAccDump._make(prodata.header_format.unpack(header) + (None,) +
+                                    prodata.trailer_format.unpack(trailer))
+
+
+def _rows(data):
+    rows = array('I')
+    rows.frombytes(data)
+    if sys.byteorder == 'big':
+        rows.byteswap()
+    return rows
+
+
+class FlightArchive:
+    """ read only view of a flight archive.  Column views are memoryviews over
+    the mapped file and are only good until the archive is closed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+
+        magic, fmt, self.count = archive_header.unpack_from(self._mm)
+        if magic != ARCHIVE_MAGIC or fmt != ARCHIVE_FORMAT:
+            self.close()
+            raise ValueError(f"{path} is not an AltAcc flight archive")
+
+        self._acc = archive_header.size + self.count * entry_format.size
+        self._pre = self._acc + self.count * SAMPLES
+        self._index = {}
+
+        offset = self._pre + self.count * SAMPLES
+        for key in INDEX_KEYS:
+            keys = self._view[offset:offset + self.count]
+            rows = _rows(self._view[offset + self.count:offset + self.count * 5])
+            self._index[key] = (keys, rows)
+            offset += self.count * 5
+
+        self.ids = [self._entry(row)[0] for row in range(self.count)]
+
+    def close(self):
+        if self._mm is not None:
+            for keys, rows in self._index.values():
+                keys.release()
+            self._view.release()
+            self._mm.close()
+            self._fp.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, row):
+        flight_id, header, trailer = entry_format.unpack_from(self._mm, archive_header.size + row * entry_format.size)
+        return flight_id.rstrip(b'\0').decode(), header, trailer
+
+    def row(self, flight_id):
+        """ row number of a flight id or None """
+
+        row = bisect_left(self.ids, flight_id)
+        return row if row < self.count and self.ids[row] == flight_id else None
+
+    def header(self, row):
+        """ the AltAccDump for a row with no flight data """
+
+        flight_id, header, trailer = self._entry(row)
+        return _dump(header, trailer)
+
+    def acc(self, row):
+        return self._view[self._acc + row * SAMPLES:self._acc + (row + 1) * SAMPLES]
+
+    def pre(self, row):
+        return self._view[self._pre + row * SAMPLES:self._pre + (row + 1) * SAMPLES]
+
+    def column(self, name):
+        """ the whole accelerometer or pressure column, flight after flight """
+
+        offset = self._acc if name == 'acc' else self._pre
+        return self._view[offset:offset + self.count * SAMPLES]
+
+    def flight(self, row):
+        """ the full AltAccDump for a row with the A P A P ... data restored """
+
+        data = bytearray(prodata.DATA_SIZE)
+        data[0::2] = self.acc(row)
+        data[1::2] = self.pre(row)
+        return self.header(row)._replace(Data=bytes(data))
+
+    def parts(self, row):
+        """ the header, trailer, accelerometer and pressure bytes of a row,
+        the columns as views of the mapped file
+        """
+
+        flight_id, header, trailer = self._entry(row)
+        return header, trailer, self.acc(row), self.pre(row)
+
+    def raw(self, row):
+        """ the original 8196 byte data file for a row """
+
+        flight = self.flight(row)
+        flight_id, header, trailer = self._entry(row)
+        return header + flight.Data + trailer
+
+    def select(self, **where):
+        """ rows matching every index key given.  A key is matched by a value
+        or by an inclusive ( lo, hi ) range, e.g. select(mode=1, apogee_pre=(150, 190))
+        """
+
+        found = None
+        for key, want in where.items():
+            if key not in self._index:
+                raise KeyError(f"no archive index on {key}")
+
+            lo, hi = want if isinstance(want, tuple) else (want, want)
+            keys, rows = self._index[key]
+            match = set(rows[bisect_left(keys, lo):bisect_right(keys, hi)])
+            found = match if found is None else found & match
+
+        return sorted(found) if found is not None else list(range(self.count))
+
+
+def _split(raw):
+    """ the header, trailer, accelerometer and pressure bytes of a data file """
+
+    trailer = prodata.altacc_format.size - prodata.trailer_format.size
+    return (raw[:prodata.DATA_OFFSET], raw[trailer:],
+            raw[prodata.DATA_OFFSET:trailer:2], raw[prodata.DATA_OFFSET + 1:trailer:2])
+
+
+def _read_split(datafile):
+    with open(datafile, 'rb') as fp:
+        return _split(fp.read())
+
+
+def _write_flights(path, flights):
+    """ write (flight id, load) pairs sorted by flight id to a new archive at
+    path.  load() gives the parts of a flight ( see _split ) and is called
+    once for each section of the file so only one flight is held at a time
+    """
+
+    count = len(flights)
+    keys = []
+
+    with open(path, 'wb') as fp:
+        fp.write(archive_header.pack(ARCHIVE_MAGIC, ARCHIVE_FORMAT, count))
+
+        for flight_id, load in flights:
+            header, trailer, acc, pre = load()
+            fp.write(entry_format.pack(flight_id.encode(), header, trailer))
+            keys.append(index_keys(_dump(header, trailer)))
+
+        for flight_id, load in flights:
+            fp.write(load()[2])
+        for flight_id, load in flights:
+            fp.write(load()[3])
+
+        for key in INDEX_KEYS:
+            order = sorted(range(count), key=lambda row: (keys[row][key], row))
+            rows = array('I', order)
+            if sys.byteorder == 'big':
+                rows.byteswap()
+            fp.write(bytes(keys[row][key] for row in order))
+            fp.write(rows.tobytes())
+
+    return count
+
+
+def write_archive(path, dumps):
+    """ write (flight id, raw data file bytes) pairs to a new archive at path """
+
+    flights = sorted((flight_id, partial(_split, raw)) for flight_id, raw in dict(dumps).items())
+
+    tmp = path + '.tmp'
+    count = _write_flights(tmp, flights)
+    os.replace(tmp, path)
+
+    return count
+
+
+def read_archive(path):
+    """ all the (flight id, raw data file bytes) pairs in an archive """
+
+    with FlightArchive(path) as arch:
+        return [(arch.ids[row], arch.raw(row)) for row in range(arch.count)]
+
+
+def import_datafiles(path, datafiles):
+    """ add data files to an archive ( creating it if need be ), a flight id
+    is the data file name without the extension and replaces any flight
+    already archived under that id.  The archived flights are copied across
+    from the mapped archive a flight at a time so an import never holds more
+    than one dump.  Returns the number of flights imported
+    """
+
+    flights = {}
+    imported = 0
+    for datafile in datafiles:
+        flight_id = os.path.splitext(os.path.basename(datafile))[0]
+        if len(flight_id.encode()) > ID_SIZE:
+            logging.warning(f"flight id {flight_id} longer than {ID_SIZE} bytes, skipped")
+            continue
+
+        try:
+            with open(datafile, 'rb') as fp:
+                prodata.unpack_datafile(fp.read())
+        except (ValueError, struct.error, OSError) as e:
+            logging.warning(f"{datafile} not imported: {e}")
+            continue
+
+        flights[flight_id] = partial(_read_split, datafile)
+        imported += 1
+
+    tmp = path + '.tmp'
+    arch = FlightArchive(path) if os.path.exists(path) else None
+    try:
+        if arch is not None:
+            for row, flight_id in enumerate(arch.ids):
+                flights.setdefault(flight_id, partial(arch.parts, row))
+        _write_flights(tmp, sorted(flights.items()))
+    finally:
+        if arch is not None:
+            arch.close()
+
+    # the old archive is closed first, it cannot be replaced while it is mapped on windows
+    os.replace(tmp, path)
+
+    return imported
+
+
+def export_datafiles(path, out_dir, ids=None):
+    """ write archived flights back out as data files, returns the file names """
+
+    names = []
+    with FlightArchive(path) as arch:
+        for flight_id in ids or arch.ids:
+            row = arch.row(flight_id)
+            if row is None:
+                logging.warning(f"flight {flight_id} is not in {path}")
+                continue
+
+            name = os.path.join(out_dir, flight_id + '.dat')
+            with open(name, 'wb') as fp:
+                fp.write(arch.raw(row))
+            names.append(name)
+
+    return names
+
+
+def reductions_path(path):
+    return path + REDUCTIONS_EXT
+
+
+def read_reductions(path):
+    """ the stored reductions for an archive by flight id, each a dict of the
+    calibration file, the calibration values used, events and summary
+    """
+
+    try:
+        with open(reductions_path(path)) as fp:
+            entries = json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+    for entry in entries.values():
+        entry['events'] = proreduce.FlightEvents._make(entry['events'])
+        entry['summary'] = proreduce.FlightSummary._make(entry['summary'])
+
+    return entries
+
+
+def write_reductions(path, entries):
+    tmp = reductions_path(path) + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(entries, fp, indent=1, sort_keys=True)
+    os.replace(tmp, reductions_path(path))
+
+
+def _slope(cal):
+    return cal.get('Slope') or proreduce.DEFAULT_GAIN
+
+
+def reduction_entry(cal_filename, cal, events, summary):
+    entry = {'cal': cal_filename, 'events': events, 'summary': summary}
+    entry.update((key, cal.get(key)) for key in ACC_PARAMS + PRESSURE_PARAMS)
+    return entry
+
+
+def _reduce_init(path, cal_filename, cal):
+    """ pool initializer, each worker maps the archive and keeps the calibration """
+
+    global worker_archive, worker_cal
+
+    worker_archive = FlightArchive(path)
+    worker_cal = (cal_filename, cal)
+
+
+def _reduce_row(flight_id):
+    cal_filename, cal = worker_cal
+    flight = worker_archive.flight(worker_archive.row(flight_id))
+
+    # only the events and summary are kept, the trace is never put together
+    pipeline = proreduce.FlightPipeline(flight, cal, _slope(cal), sum(flight.Window) / 4.0)
+
+    return flight_id, reduction_entry(cal_filename, cal, pipeline.events, pipeline.summary)
+
+
+def rereduce(path, cal_filename, ids=None, jobs=None):
+    """ bring the stored reductions up to date with a calibration file.  The
+    flights are the ids given or else every flight reduced with this
+    calibration file before.  Returns the counts of flights fully reduced,
+    with only the pressure altitudes updated and already up to date
+    """
+
+    from produce import load_calibration
+
+    cal, xducer_type = load_calibration(cal_filename)
+    entries = read_reductions(path)
+    cal_filename = os.path.abspath(cal_filename)
+
+    if ids is None:
+        ids = [flight_id for flight_id, entry in entries.items() if entry['cal'] == cal_filename]
+
+    full, pressure, current = [], [], []
+    with FlightArchive(path) as arch:
+        for flight_id in ids:
+            if arch.row(flight_id) is None:
+                logging.warning(f"flight {flight_id} is not in {path}")
+                continue
+
+            entry = entries.get(flight_id)
+            if entry is None or any(entry[key] != cal.get(key) for key in ACC_PARAMS):
+                full.append(flight_id)
+            elif entry['cal'] != cal_filename or any(entry[key] != cal.get(key) for key in PRESSURE_PARAMS):
+                pressure.append(flight_id)
+            else:
+                current.append(flight_id)
+
+        # the pressure altitudes only need the header and the stored summary
+        for flight_id in pressure:
+            entry = entries[flight_id]
+            flight = arch.header(arch.row(flight_id))
+            altitudes = proreduce.pressure_summary(flight, cal, entry['events'].apogee_pre, entry['summary'].minpre)
+            summary = entry['summary']._replace(**dict(zip(proreduce.PRESSURE_FIELDS, altitudes)))
+            entries[flight_id] = reduction_entry(cal_filename, cal, entry['events'], summary)
+
+    if full:
+        jobs = jobs or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_reduce_init,
+                                 initargs=(path, cal_filename, cal)) as pool:
+            entries.update(pool.map(_reduce_row, full, chunksize=max(1, len(full) // (jobs * 4))))
+
+    if full or pressure:
+        write_reductions(path, entries)
+
+    return len(full), len(pressure), len(current)
+
+
+def parse_range(text):
+    lo, _, hi = text.partition(':')
+    return (int(lo), int(hi or lo))
+
+
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='proarch', description=f'AltAcc flight archive (v{VERSION})')
+    parser.add_argument('--version', action='version', version=f'v{VERSION}')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('import', help='add data files to an archive')
+    cmd.add_argument('archive', help='archive filename')
+    cmd.add_argument('datafiles', nargs='+', help='data files, directories or globs')
+
+    cmd = commands.add_parser('export', help='write archived flights back out as data files')
+    cmd.add_argument('archive', help='archive filename')
+    cmd.add_argument('-o', '--out', default='.', help='output directory')
+    cmd.add_argument('ids', nargs='*', help='flight ids (default all)')
+
+    cmd = commands.add_parser('reduce', help='reduce archived flights again after a calibration change')
+    cmd.add_argument('archive', help='archive filename')
+    cmd.add_argument('-c', '--cal', required=True, help='calibration (probate) filename')
+    cmd.add_argument('-a', '--all', action='store_true', help='every flight in the archive')
+    cmd.add_argument('-j', '--jobs', type=int, help='number of worker processes (default all cores)')
+    cmd.add_argument('ids', nargs='*', help='flight ids (default those reduced with this calibration file)')
+
+    cmd = commands.add_parser('list', help='list the flights in an archive')
+    cmd.add_argument('archive', help='archive filename')
+    cmd.add_argument('-V', '--firmware', type=int, help='firmware Version')
+    cmd.add_argument('-M', '--mode', type=int, help='BSFlags flight mode (0 main only, 1 drogue to main)')
+    cmd.add_argument('-P', '--apogee', type=parse_range, help='apogee pressure or LO:HI range in Orvilles')
+
+    # the ids positional is used up ( empty ) by the first option so the ids
+    # in "reduce ARCHIVE -c CAL f01 f02" are left over, they are ids all the same
+    args, extra = parser.parse_known_args(argv)
+    if extra and getattr(args, 'ids', None) is not None and not any(arg.startswith('-') for arg in extra):
+        args.ids += extra
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    return parser, args
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+
+    if args.command == 'import':
+        paths = []
+        for spec in args.datafiles:
+            if os.path.isdir(spec):
+                spec = os.path.join(spec, '*.dat')
+            paths.extend(sorted(glob.glob(spec)))
+
+        count = import_datafiles(args.archive, paths)
+        print(f"imported {count} of {len(paths)} data files into {args.archive}")
+
+    elif args.command == 'export':
+        os.makedirs(args.out, exist_ok=True)
+        names = export_datafiles(args.archive, args.out, args.ids)
+        print(f"exported {len(names)} data files to {args.out}")
+
+    elif args.command == 'reduce':
+        ids = args.ids or None
+        if args.all:
+            with FlightArchive(args.archive) as arch:
+                ids = arch.ids
+
+        full, pressure, current = rereduce(args.archive, args.cal, ids, args.jobs)
+        print(f"reduced {full} flights, updated pressure altitudes of {pressure}, {current} already up to date")
+
+    else:
+        where = {}
+        if args.firmware is not None:
+            where['Version'] = args.firmware
+        if args.mode is not None:
+            where['mode'] = args.mode
+        if args.apogee is not None:
+            where['apogee_pre'] = args.apogee
+
+        with FlightArchive(args.archive) as arch:
+            print("%-32s  %7s  %4s  %7s  %7s" % ("Flight", "Version", "Mode", "Apogee", "BasePre"))
+            for row in arch.select(**where):
+                flight = arch.header(row)
+                keys = index_keys(flight)
+                print("%-32s  %7d  %4d  %7d  %7d" %
+                      (arch.ids[row], flight.Version, keys['mode'], keys['apogee_pre'], flight.BasePre))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,247 +1,311 @@
 """                                produce
 
 This program is to calibrate the BSR AltAcc and save results to a file
+
+With --stream it shows the live test mode samples instead, for as long as
+you like, and --log records them to a compact sample log ( see prodata )
 """
 
-import math
+import sys
+import time
 import argparse
-import logging
+from contextlib import aclosing
 from prodata import *
+from procal import sample_stats, calibrate_pressure, calibrate_acc
+from proserial import PORT, BAUD, open_port
+
+asyncio = lazy_import('asyncio')
+logging = lazy_import('logging')
 
 VERSION = "1.25c"
-PORT = "/dev/ttyUSB0"
-BAUD = 9600
 TICK_CHAR = '.'
-
-Data = namedtuple('Data', "n, sum_ squares")
-Samples = namedtuple('Samples', "acc pre")
+READOUT = 0.25              # seconds between live readout updates
+LOG_BUFFER = 4096           # sample log bytes buffered between writes
+EXIT_STATUS = 3             # exit status when the user quits at a prompt
 
 
-def parse_commandline():
-    global args, parser
-
+def parse_commandline(argv=None):
     parser = argparse.ArgumentParser(prog='probate', description=f'AltAcc calibration program (v{VERSION})')
     parser.add_argument('-p', '--port', help='serial/com port')
     parser.add_argument('-n', '--nit', default=NIT_NAME, help='override init filename')
     parser.add_argument('-o', '--out', help='output calibration filename')
 
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='stream live test mode samples instead of calibrating')
+    parser.add_argument('-l', '--log', help='record the streamed samples to this sample log file')
+    parser.add_argument('-N', '--count', type=int,
+                        help='samples for each calibration reading (default 256), or when to stop streaming')
     parser.add_argument('-q', '--quiet', action='store_true', help="be quiet about it")
     parser.add_argument('--version', action='version', version=f'v{VERSION}')
     parser.add_argument('calfile', default=None, nargs='?', action='store',
                         help='output calibration filename (same as --out)')
 
-    args = parser.parse_args()
+    return parser, parser.parse_args(argv)
+
 
+class SampleStream:
+    """ the /T test mode output as an async iterator of Samples.  It runs for
+    as long as the AltAcc sends, one line at a time, and counts the lines
+    lost to noise
+    """
 
-def set_port(port):
-    if port == 'MOCK':
-        class SerMock:
-            name = port
-            
-            def write(self, data):
-                pass
-                
-            def read(self, count):
-                return b'125 236\n'
+    def __init__(self, com):
+        self.com = com
+        self.received = 0
+        self.dropped = 0
 
-        return SerMock() 
-    else:
-        import serial
-        com = serial.Serial(port=port, baudrate=BAUD)
-        if not com:
-            print("could not open", port)
-            sys.exit(1)
+    def __aiter__(self):
+        return self._samples()
 
-        return com
+    async def _samples(self):
+        # discard any noise on the line
+        self.com.reset_input_buffer()
+        self.com.reset_output_buffer()
 
+        await self.com.write(b'/T')
 
-def get_samples(com):
-    # discard any noise on the line
-    com.reset_input_buffer()
-    com.reset_output_buffer()
+        while True:
+            try:
+                line = await self.com.readexactly(8)
 
-    com.write(b'/T')
+                # Due to the LED sharing the serial line check for and discard noise
+                if b'\x00' in line or not line.endswith(b'\n'):
+                    # attempt to sync with the end of line
+                    if not line.endswith(b'\n'):
+                        await self.com.readuntil(b'\n')
+                    self.dropped += 1
+                    continue
+            except asyncio.IncompleteReadError:
+                return
 
+            try:
+                a, p = [int(x) for x in line.strip().split()]
+            except ValueError:
+                self.dropped += 1
+                continue
+
+            self.received += 1
+            yield Samples._make((a, p))
+
+
+async def get_samples(com, count=256):
     samples = []
-    for i in range(256):
-        line = com.read(8)
-        if len(line) < 8:
-            break
+    async with aclosing(aiter(SampleStream(com))) as stream:
+        async for sample in stream:
+            samples.append(sample)
 
-        # Due to the LED sharing the serial line check for and discard noise
-        if b'\x00' in line:
-            # attempt to sync with the end of line
-            while True:
-                c = com.read(1)
-                if c == b'\n':
-                    break
-            continue
-
-        a, p = [int(x) for x in line.strip().split()]
-        
-        samples.append(Samples._make((a, p)))
-        
-        if i % 8 == 0:
-            print(TICK_CHAR, end='')
-            sys.stdout.flush()
+            if len(samples) % 8 == 1:
+                print(TICK_CHAR, end='')
+                sys.stdout.flush()
+
+            if len(samples) == count:
+                break
     print()
 
     return samples
 
 
-def get_data(com, what):
-    while True:
-        data = get_samples(com)
+async def record(samples, fp):
+    """ pass the samples on, writing them to a sample log as they go by """
+
+    fp.write(sample_log_header.pack(SAMPLE_LOG_MAGIC, time.time()))
+    buffer = bytearray()
+    try:
+        async for sample in samples:
+            buffer += bytes(sample)
+            if len(buffer) >= LOG_BUFFER:
+                fp.write(buffer)
+                buffer.clear()
+            yield sample
+    finally:
+        fp.write(buffer)
+
+
+async def monitor(stream, samples, count=None):
+    """ show the sample rate and channels live until count samples have gone
+    by or forever.  Only running sums are kept, never the samples
+    """
+
+    loop = asyncio.get_running_loop()
+    start = shown = loop.time()
+    n = shown_n = 0
+    sum_acc = sum_pre = 0
+
+    async for sample in samples:
+        n += 1
+        sum_acc += sample.acc
+        sum_pre += sample.pre
+
+        now = loop.time()
+        if now - shown >= READOUT or n == count:
+            rate = (n - shown_n) / (now - shown) if now > shown else 0.0
+            print(f"\r{rate:7.1f} samples/sec  acc {sample.acc:3d}  pre {sample.pre:3d}  "
+                  f"avg {sum_acc / n:7.2f} {sum_pre / n:7.2f}  samples {n}  noise {stream.dropped}",
+                  end='', flush=True)
+            shown, shown_n = now, n
+
+        if n == count:
+            break
 
-        print(f"received {len(data)} of 256 samples from the AltAcc on {com.name}")
+    print()
 
-        s = input("accept AltAcc data? ( y-yes | n-no | x-exit ) ")
+    return n, loop.time() - start
 
-        if s in ('x', 'X'):
-            sys.exit(3)
 
-        if s not in ('n', 'N'):  # i.e.default answer == 'y'
-            break
+async def stream(port, log_filename=None, count=None):
+    """ stream /T samples from the AltAcc on port to the screen and optionally
+    a sample log until count samples, the line closes or ^C
+    """
 
-    count = len(data)
-    sum_ = 0.0
-    squares = 0.0
+    com = await open_port(port, BAUD)
+    fp = open(log_filename, 'wb') if log_filename else None
+    try:
+        samples = SampleStream(com)
+        pipeline = aiter(samples)
+        if fp:
+            pipeline = record(pipeline, fp)
 
-    for i in range(count):
-        dtemp = data[i].pre if what == 'pre' else data[i].acc
-        sum_ += dtemp
-        squares += dtemp * dtemp
+        async with aclosing(pipeline):
+            n, elapsed = await monitor(samples, pipeline, count)
+    finally:
+        com.close()
+        if fp:
+            fp.close()
 
-    return Data._make((count, sum_, squares))
+    print(f"received {n} samples in {elapsed:.1f} sec, {samples.dropped} lines lost to noise")
+    if log_filename:
+        print(f"logged to {log_filename}")
 
 
-def main():
+def get_data(loop, com, what, count=256):
+    """ RunningStats of the 'acc' or 'pre' channel of count accepted samples,
+    None if the user exits instead
+    """
 
-    parse_commandline()
-    print()
-    print(args)
+    while True:
+        data = loop.run_until_complete(get_samples(com, count))
 
-    cal_filename = args.calfile or args.out
-    if not cal_filename:
-        parser.print_help()
-        sys.exit(1)
+        print(f"received {len(data)} of {count} samples from the AltAcc on {com.name}")
 
-    # Create a skeleton cal dict
-    cal = {k: None for k in cal_info.keys()}
+        s = input("accept AltAcc data? ( y-yes | n-no | x-exit ) ")
 
-    # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
-    nit = read_nitfile(args.nit)
-    print(nit)
+        if s in ('x', 'X'):
+            return None
 
-    # Open the com port
-    port = args.port or nit['port'] or PORT
-    com = set_port(port)
+        if s not in ('n', 'N'):  # i.e.default answer == 'y'
+            break
+
+    return sample_stats(data, what)
 
-    print(f"gathering calibration data from the AltAcc on {port}")
+
+def calibrate(loop, com, cal, count=256):
+    """ walk through the calibration prompts filling in cal, 0 when done or
+    EXIT_STATUS if the user exits at a prompt
+    """
 
     s = input("\nEnter the absolute Barometric Pressure ( x to exit ) ")
     if s.strip() in ('x', 'X'):
-        sys.exit(3)
+        return EXIT_STATUS
 
     cal['ActBP'] = float(s)
 
     s = input("\nEnter the actual altitude ( x to exit ) ")
     if s.strip() in ('x', 'X'):
-        sys.exit(3)
+        return EXIT_STATUS
 
     cal['ActAlt'] = float(s)
 
     # get_load (1, 0)
-    pre = get_data(com, "pre")
-
-    cal['AvgBP'] = pre.sum_ / pre.n
-    cal['StDBP'] = math.sqrt((pre.squares - (pre.sum_ * pre.sum_ / pre.n)) / (pre.n - 1))
-
-    # Work out offset
-    cal['OffBP'] = calc_offset(cal['ActBP'], cal['AvgBP'])
+    pre = get_data(loop, com, "pre", count)
+    if pre is None:
+        return EXIT_STATUS
 
+    calibrate_pressure(cal, pre)
     dump_calfile(None, cal)
 
     # Accelerometer calibration
-    print("\nSet the AltAcc Upside Down to Measure -1 G")
-    input("then press enter when ready ( x to quit ) ")
-    if s.strip() in ('x', 'X'):
-        sys.exit(3)
-
-    # get_load (0, 1)
-    neg = get_data(com, "acc")
-
-    cal['AvgNegG'] = neg.sum_ / neg.n
-    cal['StDNegG'] = math.sqrt((neg.squares - (neg.sum_ * neg.sum_ / neg.n)) / (neg.n - 1))
-
-    print("\nSet the AltAcc Flat to Measure Zero G")
-    input("then press enter when ready ( x to quit ) ")
-    if s.strip() in ('x', 'X'):
-        sys.exit(3)
-
-    # GetaLoadaData(0, 2);
-    zero = get_data(com, "acc")
+    orientations = []
+    for gees, desc in ((-1, "Upside Down to Measure -1 G"),
+                       (0, "Flat to Measure Zero G"),
+                       (1, "Right side Up to Measure Plus One G")):
+        print(f"\nSet the AltAcc {desc}")
+        s = input("then press enter when ready ( x to quit ) ")
+        if s.strip() in ('x', 'X'):
+            return EXIT_STATUS
+
+        acc = get_data(loop, com, "acc", count)
+        if acc is None:
+            return EXIT_STATUS
+        orientations.append((gees, acc))
+
+    calibrate_acc(cal, orientations)
 
-    cal['AvgZeroG'] = zero.sum_ / zero.n
-    cal['StDZeroG'] = math.sqrt((zero.squares - (zero.sum_ * zero.sum_ / zero.n)) / (zero.n - 1))
-
-    cal['FiDNegG'] = cal['AvgZeroG'] - cal['AvgNegG']
-
-    print("\nSet the AltAcc Right side Up to Measure Plus One G")
-    input("then press enter when ready ( x to quit ) ")
-
-    # GetaLoadaData(0, 3);
-    one = get_data(com, "acc")
-
-    cal['AvgOneG'] = one.sum_ / one.n
-    cal['StDOneG'] = math.sqrt((one.squares - (one.sum_ * one.sum_ / one.n)) / (one.n - 1))
+    # Test for proper operation and a good unit
+    if cal['FiDNegG'] <= 0.0 or cal['FiDZeroG'] <= 0.0:
+        print("\n*** Warning *** Average Values indicate calibration error")
+        s = input("                or a defective unit.  Save data? ( y | n ) ")
+        if s in ('y', 'Y'):
+            return EXIT_STATUS
 
-    cal['FiDZeroG'] = cal['AvgOneG'] - cal['AvgZeroG']
+    return 0
 
-    # calculate slope.  Least Squares is simplified with X = { -1,0,+1 }
-    cal['Slope'] = (one.sum_ - neg.sum_) / (one.n + neg.n)
 
-    # Y-Intercept is the Avg G Value:
-    cal['YZero'] = (one.sum_ + zero.sum_ + neg.sum_) / (one.n + zero.n + neg.n)
+def main(argv=None):
 
-    # Correlation Coefficient = 1 - std^2_y_x / std_y^2
+    parser, args = parse_commandline(argv)
+    print()
+    print(args)
 
-    # Estimate Output at G = -1, do sum of diff squared
-    dtemp = cal['AvgNegG'] - (-1 * cal['Slope'] + cal['YZero'])
-    std_y_x = neg.sum_ * neg.sum_ * dtemp * dtemp
+    if args.stream:
+        nit = read_nitfile(args.nit)
+        port = args.port or nit['port'] or PORT
+        try:
+            asyncio.run(stream(port, args.log, args.count))
+        except OSError as e:
+            print(e)
+            return 1
+        except KeyboardInterrupt:
+            print()
+        return 0
 
-    # Estimate Output at G = 0
-    dtemp = cal['AvgZeroG'] - cal['YZero']
-    std_y_x += (zero.sum_ * zero.sum_ * dtemp * dtemp)
+    cal_filename = args.calfile or args.out
+    if not cal_filename:
+        parser.print_help()
+        return 1
 
-    # Estimate Output at G = 1
-    dtemp = cal['AvgOneG'] - (cal['Slope'] + cal['YZero'])
-    std_y_x = one.sum_ * one.sum_ * dtemp * dtemp
+    # Create a skeleton cal dict
+    cal = {k: None for k in cal_info.keys()}
 
-    dtemp = one.sum_ + zero.sum_ + neg.sum_
-    n = one.n + zero.n + neg.n
+    # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
+    nit = read_nitfile(args.nit)
+    print(nit)
 
-    std_y_x /= n - 2
+    # Open the com port, the samples are gathered on this loop between prompts
+    port = args.port or nit['port'] or PORT
+    loop = asyncio.new_event_loop()
+    try:
+        com = loop.run_until_complete(open_port(port, BAUD))
+    except OSError as e:
+        print(e)
+        return 1
 
-    std_y = ((one.squares + zero.squares + neg.squares) - ((dtemp * dtemp) / n)) / (n - 1)
-    if std_y > 0:
-        cal['CCoff'] = 1.0 - (std_y_x / std_y)
+    print(f"gathering calibration data from the AltAcc on {port}")
+    try:
+        status = calibrate(loop, com, cal, args.count or 256)
+    finally:
+        com.close()
+        loop.run_until_complete(asyncio.sleep(0))   # let a cancelled simulator finish
+        loop.close()
+    if status:
+        return status
 
-    # Test for proper operation and a good unit
-    if cal['FiDNegG'] <= 0.0 or cal['FiDZeroG'] <= 0.0:
-        print("\n*** Warning *** Average Values indicate calibration error")
-        s = input("                or a defective unit.  Save data? ( y | n ) ")
-        if s in ('y', 'Y'):
-            sys.exit(3)
- 
     dump_calfile(cal_filename, cal)
 
     if not args.quiet:
         dump_calfile(None, cal)
 
+    return 0
 
-if "win" not in sys.platform:
-    # For Pythonsita bug in debug
-    sys.argv = ['probate.py', 'pb.cal']
 
-main()
+if __name__ == '__main__':
+    sys.exit(main())
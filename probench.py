@@ -0,0 +1,465 @@
+""" probench
+
+This program times the AltAcc hot paths so we can see what they cost and
+catch it when a change makes one slower
+
+    parse       read_datafile, map_datafile, unpack_datafile, read_calfile, read_nitfile
+    reduce      the original per sample loop from produce and reduce_flight, checked
+                against each other and the pressure tables against palt3, pressure_alt
+                and alt.py first
+    report      report2 ASCII, CSV and npz rendering
+    download    proread downloads from simulated units ( prosim, no pacing )
+    archive     write, open, query, event scan and reduce synthetic archives
+    kernels     every integration and derivative kernel over a flight trace
+    startup     cold start of the programs on their own and through altacc
+
+Every run is appended to the results file ( bench_output.txt ) and each time
+is compared with the last run recorded under the same name.
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import timeit
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import prodata
+import proreduce
+from proreduce import LAUNCH_THOLD, DEFAULT_GAIN, GEE, dT, simpson, taylor
+
+VERSION = "1.25c"
+SUITES = ('parse', 'reduce', 'report', 'download', 'archive', 'kernels', 'startup')
+RESULTS_NAME = 'bench_output.txt'
+POOL = 64                   # distinct flights behind a synthetic archive
+REDUCE_ROWS = 100           # most archive flights reduced per timing run
+
+
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='probench', description=f'AltAcc benchmarks (v{VERSION})')
+    parser.add_argument('-c', '--cal', default=prodata.CAL_NAME, help='calibration (probate) filename')
+    parser.add_argument('-n', '--nit', default=prodata.NIT_NAME, help='init filename')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timing runs')
+    parser.add_argument('-N', '--number', type=int, default=20, help='calls per timing run')
+    parser.add_argument('-s', '--suite', default=','.join(SUITES), help='comma separated suites to run')
+    parser.add_argument('-S', '--sizes', default='1,100,10000',
+                        help='comma separated synthetic archive sizes in flights (up to 100000)')
+    parser.add_argument('-u', '--units', type=int, default=8, help='simulated units for the concurrent download')
+    parser.add_argument('-o', '--out', default=RESULTS_NAME, help='results file to compare with and append to')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0, help='percent slower that is a regression')
+    parser.add_argument('--no-record', action='store_true', help='do not append this run to the results file')
+    parser.add_argument('--strict', action='store_true', help='exit with an error if anything regressed')
+    parser.add_argument('--version', action='version', version=f'v{VERSION}')
+    parser.add_argument('datafile', default='sample.dat', nargs='?', action='store', help='data filename')
+
+    return parser, parser.parse_args(argv)
+
+
+def legacy_reduce(flight, slope, onegee, all_data=False):
+    """ the original sample by sample reduction loop from produce.main kept
+    as the baseline for timing and as the reference for the results
+    """
+
+    goffset = onegee
+    events = proreduce.flight_events(flight)
+    main_time, drogue_time = events.main_time, events.drogue_time
+
+    oacc = 0.0
+    vel = 0.0
+    multiplier = dT * GEE / slope / 2
+
+    tee, vee, gee, pre = [], [], [], []
+
+    for i in range(4):
+        tee.append((i - 3) * dT)
+        vee.append(0.0)
+        pre.append(flight.BasePre)
+
+        win_ptr = (flight.WinPtr + i + 1) % 4
+        gee.append(flight.Window[win_ptr])
+
+    for i in range(4):
+        cacc = flight.NitAcc[i] - onegee
+        vel += (oacc + cacc) * multiplier
+
+        tee.append((i + 1) * dT)
+        vee.append(vel)
+        pre.append(flight.BasePre)
+        gee.append(flight.NitAcc[i])
+
+        oacc = cacc
+
+    t = 4 * dT
+    for i in range(len(flight.Data) // 2):
+        cacc = flight.Data[i * 2] - onegee
+        vel += (oacc + cacc) * multiplier
+
+        if t in (main_time, drogue_time):
+            t += dT * 4
+        else:
+            t += dT
+
+        tee.append(t)
+        vee.append(vel)
+        gee.append(flight.Data[i * 2])
+        pre.append(flight.Data[i * 2 + 1])
+
+        if flight.Data[i * 2 + 1] == 254:
+            break
+
+        oacc = cacc
+
+    tee.extend((0.0, 0.0))
+    vee.extend((0.0, 0.0))
+    gee.extend((0.0, 0.0))
+    pre.extend((0.0, 0.0))
+
+    oalt = 0.0
+    launch = False
+    atime = None
+    end_of_time = None
+
+    maxialt, tmaxialt = 0.0, 0.0
+    maxvel, tmaxvel = 0.0, 0.0
+    minacc, tminacc = 0.0, -1.0
+    maxacc, tmaxacc = 0.0, 0.0
+    minpre, tminpre = 255, 0.0
+    maxpre, tmaxpre = 0, 0.0
+
+    acc, ialt, palt, gsum = [], [], [], []
+
+    for i, t in enumerate(tee):
+        if pre[i] == 254 or (end_of_time and t > end_of_time):
+            break
+
+        if i > 3:
+            dalt = simpson(i, vee, dT) - oalt
+            oalt = dalt
+
+            ialt.append(ialt[-1] + dalt)
+            palt.append(prodata.palt3(pre[i], flight.BasePre) or 0.0)
+            acc.append(taylor(i, vee, 12 * dT))
+            gsum.append(gsum[-1] + gee[i] - goffset)
+
+            if not launch and gsum[i] > LAUNCH_THOLD:
+                launch = True
+
+            if launch and gsum[i] <= 0.0 and not atime:
+                atime = t
+        else:
+            acc.append(0.0)
+            ialt.append(0.0)
+            palt.append(0.0)
+            gsum.append(0.0)
+
+        if pre[i] > maxpre:
+            maxpre = pre[i]
+            tmaxpre = t
+
+        if pre[i] <= minpre:
+            minpre = pre[i]
+            tminpre = t
+
+        if not atime or t <= atime:
+            if ialt[i] > maxialt:
+                maxialt = ialt[i]
+                tmaxialt = t
+
+            if vee[i] > maxvel:
+                maxvel = vee[i]
+                tmaxvel = t
+
+            if gsum[i] >= 0.0:
+                if acc[i] < minacc:
+                    minacc = acc[i]
+                    tminacc = t
+
+                if acc[i] > maxacc:
+                    maxacc = acc[i]
+                    tmaxacc = t
+        else:
+            if not all_data and pre[i] >= flight.BasePre and not end_of_time:
+                end_of_time = t + 5.0
+
+    n = len(acc)
+    trace = (tee[:n], gee[:n], pre[:n], vee[:n], acc, ialt, palt, gsum)
+    peaks = (atime, end_of_time, maxialt, tmaxialt, maxvel, tmaxvel, minacc, tminacc, maxacc, tmaxacc,
+             minpre, tminpre, maxpre, tmaxpre)
+
+    return trace, peaks
+
+
+def check(flight, cal, slope, onegee):
+    """ make sure the reduction engine agrees with the legacy loop """
+
+    trace, peaks = legacy_reduce(flight, slope, onegee)
+    reduction = proreduce.reduce_flight(flight, cal, slope, onegee)
+
+    for name, old, new in zip(proreduce.FlightTrace._fields, trace, reduction.trace):
+        same = np.array_equal(old, new)
+        if name == 'gsum' and len(old) == len(new):
+            # gsum only agrees to the last digit for a onegee in 1/4 counts
+            same = np.allclose(old, new, rtol=1e-12, atol=1e-9)
+        if not same:
+            raise ValueError(f"reduce_flight {name} trace does not match the legacy loop")
+
+    if peaks != tuple(reduction.summary[:len(peaks)]):
+        raise ValueError("reduce_flight summary does not match the legacy loop")
+
+
+def _altitude(func, *args):
+    try:
+        return func(*args)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def check_tables(cal):
+    """ make sure the pressure altitude tables agree with the formulas they
+    replace, palt3, pressure_alt and the alt.py originals.  alt.palt2 rounds
+    its exponent so it only has to agree to 1e-4
+    """
+
+    import alt
+
+    for press_0 in range(1, 256):
+        biba = prodata.palt3_table(press_0)
+        site = proreduce.pressure_alt_table(press_0, cal)
+        legacy = proreduce.pressure_alt_table(press_0, alt.cali_data)
+
+        for press in range(256):
+            if biba[press] != prodata.palt3(press, press_0):
+                raise ValueError(f"palt3_table does not match palt3 at {press} against {press_0}")
+            if site[press] != _altitude(proreduce.pressure_alt, press, press_0, cal):
+                raise ValueError(f"pressure_alt_table does not match pressure_alt at {press} against {press_0}")
+            if legacy[press] != _altitude(alt.palt, press, press_0):
+                raise ValueError(f"pressure_alt_table does not match alt.palt at {press} against {press_0}")
+
+            palt2 = _altitude(alt.palt2, press, press_0)
+            if (palt2 is None) != (legacy[press] is None) or (
+                    palt2 is not None and abs(palt2 - legacy[press]) > 1e-4 * max(abs(palt2), 1.0)):
+                raise ValueError(f"pressure_alt_table does not match alt.palt2 at {press} against {press_0}")
+
+
+def bench(args, stmt, number=None, repeat=None):
+    """ best time in seconds per call of stmt, args.number calls args.repeat
+    times unless number or repeat are given
+    """
+
+    number = number or args.number
+    return min(timeit.repeat(stmt, number=number, repeat=repeat or args.repeat)) / number
+
+
+def synthetic_dumps(raw, count, seed=0):
+    """ count (flight id, data file bytes) pairs made from one real dump.  A
+    pool of variants with the accelerometer readings jittered is shared
+    between the flights so even 100k flights take little memory
+    """
+
+    rng = random.Random(seed)
+    end = prodata.CKSUM_OFFSET
+    pool = []
+    for k in range(min(count, POOL)):
+        data = bytearray(raw[:end])
+        for i in range(prodata.DATA_OFFSET, end, 2):
+            if data[i + 1] == prodata.END_OF_DATA:
+                break
+            data[i] = min(max(data[i] + rng.randint(-1, 1), 0), 255)
+        pool.append(bytes(data) + prodata.trailer_format.pack(sum(data) % 0x10000, b'OK'))
+
+    return [(f"syn{i:06d}", pool[i % len(pool)]) for i in range(count)]
+
+
+def map_flight(path):
+    with prodata.map_datafile(path, verify=True) as flight:
+        return flight.Version
+
+
+def bench_parse(args, ctx):
+    with open(args.datafile, 'rb') as fp:
+        raw = fp.read()
+
+    yield 'read_datafile', bench(args, lambda: prodata.read_datafile(args.datafile))
+    yield 'map_datafile', bench(args, lambda: map_flight(args.datafile))
+    yield 'unpack_datafile', bench(args, lambda: prodata.unpack_datafile(raw))
+    yield 'read_calfile', bench(args, lambda: prodata.read_calfile(args.cal))
+    yield 'read_nitfile', bench(args, lambda: prodata.read_nitfile(args.nit))
+
+
+def bench_reduce(args, ctx):
+    flight, cal, slope, onegee = ctx['flight'], ctx['cal'], ctx['slope'], ctx['onegee']
+
+    check(flight, cal, slope, onegee)
+    check_tables(cal)
+
+    yield 'legacy loop', bench(args, lambda: legacy_reduce(flight, slope, onegee))
+    yield 'reduce_flight', bench(args, lambda: proreduce.reduce_flight(flight, cal, slope, onegee))
+
+
+def bench_report(args, ctx):
+    import produce
+
+    rpt = produce.Report._make((args.datafile, args.cal, 'MPX4100', ctx['cal'], ctx['slope'], ctx['onegee'],
+                                ctx['flight'], ctx['reduction']))
+
+    yield 'report2 ascii', bench(args, lambda: produce.report2(io.StringIO(), rpt, 'A'))
+    yield 'report2 csv', bench(args, lambda: produce.report2(io.StringIO(), rpt, 'C'))
+    yield 'report2 npz', bench(args, lambda: produce.report2(io.BytesIO(), rpt, 'N'))
+
+
+def bench_download(args, ctx):
+    import proread
+
+    port = 'sim:' + args.datafile
+
+    async def download(count, port=port):
+        progress = proread.Progress([port], prodata.altacc_format.size, quiet=True)
+        results = await asyncio.gather(*(proread.download(port, None, progress, baud=0) for i in range(count)))
+        if any(result.error or not result.check.complete for result in results):
+            raise ValueError("simulated download failed")
+
+    number = max(1, args.number // 4)
+    yield 'download', bench(args, lambda: asyncio.run(download(1)), number)
+    yield f'download x{args.units}', bench(args, lambda: asyncio.run(download(args.units)), number)
+    yield 'download line errors', bench(args, lambda: asyncio.run(download(1, port + '?errors=0.0005&seed=1')), number)
+
+
+def bench_archive(args, ctx):
+    import proarch
+
+    with open(args.datafile, 'rb') as fp:
+        raw = fp.read()
+    cal, slope, onegee = ctx['cal'], ctx['slope'], ctx['onegee']
+
+    def events(arch):
+        for row in range(arch.count):
+            proreduce.flight_events(arch.header(row))
+
+    def reduce(arch):
+        for row in range(min(arch.count, REDUCE_ROWS)):
+            proreduce.reduce_flight(arch.flight(row), cal, slope, onegee)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (int(n) for n in args.sizes.split(',') if n):
+            path = os.path.join(tmp, f"syn{size}.arch")
+            dumps = synthetic_dumps(raw, size)
+            repeat = min(args.repeat, 3)
+
+            yield f'archive[{size}] write', bench(args, lambda: proarch.write_archive(path, dumps), 1, repeat)
+            yield f'archive[{size}] open', bench(args, lambda: proarch.FlightArchive(path).close())
+
+            with proarch.FlightArchive(path) as arch:
+                yield f'archive[{size}] select', bench(args, lambda: arch.select(mode=1, apogee_pre=(0, 200)))
+                yield f'archive[{size}] events', bench(args, lambda: events(arch), 1, repeat)
+                yield f'archive[{size}] reduce', bench(args, lambda: reduce(arch), 1, repeat) / min(size, REDUCE_ROWS)
+
+            os.remove(path)
+
+
+def bench_kernels(args, ctx):
+    trace = ctx['reduction'].trace
+    cacc = trace.gee - ctx['onegee']
+
+    for name, func in proreduce.INTEGRATORS.items():
+        yield f'integrate {name}', bench(args, lambda: func(cacc, dT))
+    for name, func in proreduce.DIFFERENTIATORS.items():
+        yield f'differentiate {name}', bench(args, lambda: func(trace.vee, dT))
+
+
+def bench_startup(args, ctx):
+    """ each is a fresh interpreter, the scripts are compiled every run and
+    altacc imports the compiled programs
+    """
+
+    def run(*argv):
+        subprocess.run([sys.executable] + list(argv), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    reduce = ('-n', args.nit, '-c', args.cal, '-G', 'none', '-q', args.datafile)
+    number = max(1, args.number // 4)
+    yield 'proread --help', bench(args, lambda: run('proread.py', '--help'), number)
+    yield 'altacc read --help', bench(args, lambda: run('altacc.py', 'read', '--help'), number)
+    yield 'produce', bench(args, lambda: run('produce.py', *reduce), number)
+    yield 'altacc reduce', bench(args, lambda: run('altacc.py', 'reduce', *reduce), number)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return '-'
+
+
+def read_results(path):
+    """ the last recorded time for each benchmark name """
+
+    last = {}
+    try:
+        with open(path) as fp:
+            for line in fp:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 4:
+                    last[fields[2]] = float(fields[3])
+    except (OSError, ValueError):
+        pass
+
+    return last
+
+
+def record_results(path, results):
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    rev = git_revision()
+    with open(path, 'a') as fp:
+        for name, sec in results:
+            fp.write(f"{stamp}\t{rev}\t{name}\t{sec:.9f}\n")
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+
+    suites = [name for name in args.suite.split(',') if name]
+    for name in suites:
+        if name not in SUITES:
+            parser.error(f"unknown suite {name}, pick from {', '.join(SUITES)}")
+
+    ctx = {'cal': prodata.read_calfile(args.cal), 'flight': prodata.read_datafile(args.datafile)}
+    ctx['slope'] = ctx['cal'].get('Slope') or DEFAULT_GAIN
+    ctx['onegee'] = sum(ctx['flight'].Window) / 4.0
+    ctx['reduction'] = proreduce.reduce_flight(ctx['flight'], ctx['cal'], ctx['slope'], ctx['onegee'])
+
+    last = read_results(args.out)
+    results = []
+    regressed = []
+
+    print(f"{'benchmark':32}  {'msec/call':>11}  {'calls/sec':>11}  {'vs last':>8}")
+    for suite in suites:
+        for name, sec in globals()['bench_' + suite](args, ctx):
+            name = f"{suite}: {name}"
+            results.append((name, sec))
+
+            change = ''
+            if last.get(name):
+                pct = (sec - last[name]) / last[name] * 100
+                change = f"{pct:+7.1f}%"
+                if pct > args.threshold:
+                    change += ' *'
+                    regressed.append(name)
+
+            print(f"{name:32}  {sec * 1000:11.3f}  {1 / sec:11.1f}  {change:>8}", flush=True)
+
+    if not args.no_record:
+        record_results(args.out, results)
+
+    if regressed:
+        print(f"{len(regressed)} benchmarks more than {args.threshold:.0f}% slower than the last run ( * )")
+
+    return 1 if regressed and args.strict else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
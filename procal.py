@@ -0,0 +1,234 @@
+""" procal
+
+These are the calibration statistics for the BSR AltAcc software and a
+program to recalibrate from sample logs recorded by probate --log.
+
+The statistics are updated a sample, or a block of samples, at a time with
+Welford's method and merged with Chan's formulas, so they stay accurate
+for any number of samples and nothing has to be kept but the running
+moments.  The accelerometer line is a least squares fit over any number
+of orientations, each a known number of gees, e.g. upside down, on its
+side and right side up ( -1, 0, +1 ) or more.
+"""
+
+import sys
+import math
+import argparse
+from itertools import islice
+import prodata
+
+VERSION = "1.25c"
+BLOCK = 4096                # samples summarized at a time from a log
+
+
+class RunningStats:
+    """ count, mean and sum of squared deviations of a stream of values """
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        return self
+
+    def extend(self, values):
+        """ add a block of values at once """
+
+        values = list(values)
+        if values:
+            mean = math.fsum(values) / len(values)
+            self.merge(RunningStats(len(values), mean, math.fsum((x - mean) ** 2 for x in values)))
+        return self
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n:
+            delta = other.mean - self.mean
+            self.mean += delta * other.n / n
+            self.m2 += other.m2 + delta * delta * self.n * other.n / n
+            self.n = n
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class LinearFit:
+    """ least squares line y = slope * x + intercept kept as running co-moments """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = self.mean_y = 0.0
+        self.m2x = self.m2y = self.cxy = 0.0
+
+    def update(self, x, y):
+        self.n += 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += dx / self.n
+        self.mean_y += dy / self.n
+        self.m2x += dx * (x - self.mean_x)
+        self.m2y += dy * (y - self.mean_y)
+        self.cxy += dx * (y - self.mean_y)
+        return self
+
+    def add_group(self, x, stats):
+        """ merge the RunningStats of a group of y values all taken at x """
+
+        n = self.n + stats.n
+        if stats.n:
+            dx = x - self.mean_x
+            dy = stats.mean - self.mean_y
+            w = self.n * stats.n / n
+            self.m2x += dx * dx * w
+            self.m2y += stats.m2 + dy * dy * w
+            self.cxy += dx * dy * w
+            self.mean_x += dx * stats.n / n
+            self.mean_y += dy * stats.n / n
+            self.n = n
+        return self
+
+    @property
+    def slope(self):
+        return self.cxy / self.m2x if self.m2x else 0.0
+
+    @property
+    def intercept(self):
+        return self.mean_y - self.slope * self.mean_x
+
+    @property
+    def correlation(self):
+        """ Pearson's r """
+
+        return self.cxy / math.sqrt(self.m2x * self.m2y) if self.m2x and self.m2y else 0.0
+
+    @property
+    def determination(self):
+        """ 1 - std^2_y_x / std_y^2, the fraction of the variance the line explains """
+
+        if self.n < 3 or not self.m2y:
+            return 0.0
+        sse = max(self.m2y - self.slope * self.cxy, 0.0)
+        return 1.0 - (sse / (self.n - 2)) / (self.m2y / (self.n - 1))
+
+
+def sample_stats(samples, what):
+    """ RunningStats of the 'acc' or 'pre' channel of Samples, a block at a time """
+
+    stats = RunningStats()
+    samples = iter(samples)
+    index = prodata.Samples._fields.index(what)
+    while block := list(islice(samples, BLOCK)):
+        stats.extend(sample[index] for sample in block)
+    return stats
+
+
+def calibrate_pressure(cal, pre):
+    """ fill in the pressure calibration from its RunningStats, cal already
+    has the actual barometric pressure
+    """
+
+    cal['AvgBP'] = pre.mean
+    cal['StDBP'] = pre.std
+
+    # Work out offset
+    cal['OffBP'] = prodata.calc_offset(cal['ActBP'], cal['AvgBP'])
+
+
+def calibrate_acc(cal, orientations):
+    """ fill in the accelerometer calibration from a list of ( gees,
+    RunningStats ) orientations and return the LinearFit
+    """
+
+    fit = LinearFit()
+    at = {}
+    for gees, stats in orientations:
+        fit.add_group(gees, stats)
+        at.setdefault(gees, RunningStats()).merge(stats)
+
+    for gees, avg, std in ((-1, 'AvgNegG', 'StDNegG'), (0, 'AvgZeroG', 'StDZeroG'), (1, 'AvgOneG', 'StDOneG')):
+        if gees in at:
+            cal[avg] = at[gees].mean
+            cal[std] = at[gees].std
+
+    if -1 in at and 0 in at:
+        cal['FiDNegG'] = at[0].mean - at[-1].mean
+    if 0 in at and 1 in at:
+        cal['FiDZeroG'] = at[1].mean - at[0].mean
+
+    cal['Slope'] = fit.slope
+    cal['YZero'] = fit.intercept
+    cal['CCoff'] = fit.determination
+
+    return fit
+
+
+def calibrate(cal, pre, orientations):
+    calibrate_pressure(cal, pre)
+    return calibrate_acc(cal, orientations)
+
+
+def parse_orientation(text):
+    gees, _, path = text.partition(':')
+    if not path:
+        raise argparse.ArgumentTypeError(f"expected GEES:LOGFILE, not {text}")
+    return float(gees), path
+
+
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='procal', description=f'AltAcc recalibration from sample logs (v{VERSION})')
+    parser.add_argument('-b', '--actbp', type=float, required=True, help='actual barometric pressure')
+    parser.add_argument('-a', '--actalt', type=float, default=0.0, help='actual altitude')
+    parser.add_argument('-p', '--pre', required=True, help='sample log for the pressure')
+    parser.add_argument('-g', '--gees', type=parse_orientation, action='append', required=True,
+                        help='GEES:LOGFILE sample log for an orientation, e.g. -g=-1:neg.log, repeat for each')
+    parser.add_argument('-q', '--quiet', action='store_true', help="be quiet about it")
+    parser.add_argument('--version', action='version', version=f'v{VERSION}')
+    parser.add_argument('calfile', help='output calibration filename')
+
+    return parser, parser.parse_args(argv)
+
+
+def log_stats(path, what):
+    start, samples = prodata.read_sample_log(path)
+    return sample_stats(samples, what)
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+
+    cal = {k: None for k in prodata.cal_info.keys()}
+    cal['ActBP'] = args.actbp
+    cal['ActAlt'] = args.actalt
+
+    try:
+        pre = log_stats(args.pre, 'pre')
+        orientations = [(gees, log_stats(path, 'acc')) for gees, path in args.gees]
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+
+    fit = calibrate(cal, pre, orientations)
+    if not args.quiet:
+        for (gees, path), (g, stats) in zip(args.gees, orientations):
+            print(f"{gees:+5.1f} G  {stats.n:7d} samples  avg {stats.mean:9.4f}  std {stats.std:7.4f}  {path}")
+        print(f"slope {fit.slope:.4f} per G  intercept {fit.intercept:.4f}  r {fit.correlation:.6f}")
+
+    prodata.dump_calfile(args.calfile, cal)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,58 +1,94 @@
 """                                produce
 
 This program is to clear the AltAcc flight data memory
+
+Any number of units are cleared at once.  Each is given CLEAR_TIME seconds
+for the erase, as before.  The wait ends early if a unit sends OK.  That reply
+is an assumption: the simulator ( prosim ) sends it, but it has not been
+confirmed on a real unit.  A unit that stays quiet is taken to be done when
+the CLEAR_TIME is up.
 """
 
-import time
+import sys
 import argparse
-import logging
 from prodata import *
+from proserial import PORT, BAUD, open_port
+
+asyncio = lazy_import('asyncio')
+logging = lazy_import('logging')
 
 VERSION = "1.25c"
-PORT = "/dev/ttyUSB0"
-BAUD = 9600
 TICK_CHAR = '.'
-CLEAR_TIME = 55
+CLEAR_TIME = 55             # seconds the EEProm erase takes
+CLEAR_REPLY = b'OK'         # assumed end of erase reply, only the simulator is known to send it
 
 
-def parse_commandline():
-    global args, parser
-
-    parser = argparse.ArgumentParser(prog='probate', description=f'Clear AltAcc flight data EEProm (v{VERSION})')
-    parser.add_argument('-p', '--port', help='serial/com port')
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='proclear', description=f'Clear AltAcc flight data EEProm (v{VERSION})')
+    parser.add_argument('-p', '--port', action='append',
+                        help='serial/com port, repeat or comma separate to clear several units at once')
     parser.add_argument('-n', '--nit', default=NIT_NAME, help='override init filename')
+    parser.add_argument('-t', '--timeout', type=float, default=CLEAR_TIME,
+                        help=f'seconds to wait for the AltAcc to finish (default {CLEAR_TIME})')
     parser.add_argument('-q', '--quiet', action='store_true', help="be quiet about it")
     parser.add_argument('-y', '--yes', action='store_true', help="assume yes to all prompts")
     parser.add_argument('--version', action='version', version=f'v{VERSION}')
 
-    args = parser.parse_args()
+    return parser, parser.parse_args(argv)
+
+
+async def clear(port, timeout=CLEAR_TIME):
+    """ send the clear command and wait timeout seconds for the erase, less
+    if the AltAcc says it is done.  Returns the seconds it took or None if it
+    never said so, raises OSError if the port cannot be opened
+    """
+
+    com = await open_port(port, BAUD)
+    loop = asyncio.get_running_loop()
+
+    try:
+        # discard any noise on the line
+        com.reset_input_buffer()
+        com.reset_output_buffer()
+
+        await com.write(b'/CC')
+        start = loop.time()
 
+        try:
+            await com.readuntil(CLEAR_REPLY, timeout)
+        except asyncio.IncompleteReadError:
+            return None
 
-def set_port(port):
-    if port == 'MOCK':
-        class SerMock:
-            name = port
+        return loop.time() - start
+    finally:
+        com.close()
 
-            def write(self, data):
-                pass
 
-            def read(self, _):
-                return b'125 236\n'
+async def clear_all(ports, timeout=CLEAR_TIME, quiet=False):
+    """ clear every port at once, a tick a second while any is still erasing.
+    Returns a seconds, None or OSError result for each port
+    """
 
-        return SerMock()
-    else:
-        import serial
-        com = serial.Serial(port=port, baudrate=BAUD)
-        if not com:
-            print(f"could not open {port}")
-            sys.exit(1)
+    if not quiet:
+        print("clearing the AltAcc on ", ', '.join(ports))
+        # a tick a second fills the bar by the timeout
+        print("|" + " " * max(round(timeout) - 2, 0) + "|")
 
-        return com
+    pending = asyncio.gather(*(clear(port, timeout) for port in ports), return_exceptions=True)
+    while not pending.done():
+        await asyncio.wait([pending], timeout=1)
+        if not quiet and not pending.done():
+            print(TICK_CHAR, end='', flush=True)
 
+    if not quiet:
+        print()
+
+    return pending.result()
 
-def main():
 
-    parse_commandline()
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
 
     # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
     nit = read_nitfile(args.nit)
@@ -60,31 +96,26 @@ def main():
     if not args.yes:
         s = input("\nDo you really mean to clear all data from the AltAcc? (y|n) ")
         if s.strip().lower() != 'y':
-            sys.exit(3)
-
-    # Open the com port
-    port = args.port or nit['port'] or PORT
-    com = set_port(port)
+            return 3
 
-    if not args.quiet:
-        print("clearing the AltAcc on ", port)
-        print("|                                                     |")
+    # Open the com ports
+    ports = [p for spec in args.port or [nit['port'] or PORT] for p in spec.split(',') if p]
+    results = asyncio.run(clear_all(ports, args.timeout, args.quiet))
 
-    # discard any noise on the line
-    com.reset_input_buffer()
-    com.reset_output_buffer()
+    status = 0
+    for port, result in zip(ports, results):
+        if isinstance(result, OSError):
+            print(result)
+            status = 1
+        elif result is None:
+            # no reply is what a unit is known to do, the full erase time has passed
+            if not args.quiet:
+                print(f"{port}: cleared ( waited {args.timeout:.0f} sec )")
+        elif not args.quiet:
+            print(f"{port}: cleared in {result:.1f} sec")
 
-    com.write(b'/CC')
-
-    # Wait...
-    for _ in range(CLEAR_TIME):
-        if not args.quiet:
-            print(TICK_CHAR, end='')
-
-        time.sleep(1)
-
-    if not args.quiet:
-        print()
+    return status
 
 
-main()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -31,10 +31,35 @@ byte  K ;                        /* AltAcc sez 'K'                 */
 """
 
 import sys
+import mmap
 import struct
-import logging
-import datetime
+import hashlib
+import importlib.util
 from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+
+
+def lazy_import(name: str):
+    """ a module that is only really imported when one of its attributes is
+    first used, so the programs start ( and print their --help ) without
+    paying for modules a run may never need
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+logging = lazy_import('logging')
+datetime = lazy_import('datetime')
 
 NIT_NAME = "prodata.nit"
 CAL_NAME = "prodata.cal"
@@ -101,6 +126,30 @@ data_info = {
 altacc_format = struct.Struct("<B3x4B4BBBBB4sB4sBB5x8160sH2s")
 AltAccDump = namedtuple('AltAccDump', ' '.join(data_info.keys()))
 
+# a parsed calibration file: the SHA-1 of its contents, the (key, value)
+# pairs as read and the values the reduction uses worked out from them as
+# produce does ( see calibration_values )
+CalFile = namedtuple('CalFile', 'digest cal slope zero_gee gain offset')
+_parsed = {}
+
+# the same layout in pieces so the header and trailer can be read in place
+header_format = struct.Struct("<B3x4B4BBBBB4sB4sBB5x")
+trailer_format = struct.Struct("<H2s")
+DATA_OFFSET = header_format.size
+DATA_SIZE = altacc_format.size - header_format.size - trailer_format.size
+CKSUM_OFFSET = DATA_OFFSET + DATA_SIZE
+WINPTR_OFFSET = 15              # WinPtr indexes the 4 byte Window []
+END_OF_DATA = 254               # pressure channel marker for the end of the flight
+PALT_TABLES = 512               # pressure altitude tables cached, about 8k each
+PARSE_CACHE = 64                # parsed nit and calibration files kept
+DEFAULT_GAIN = 2.5500           # +/- 50 G over 255 units, the slope without a calibration
+
+# a /T test mode sample and the sample log probate records them to: the
+# header then an acc, pre byte pair for every sample in the order received
+Samples = namedtuple('Samples', "acc pre")
+SAMPLE_LOG_MAGIC = b'ALTACCT1'
+sample_log_header = struct.Struct("<8sd")     # magic, start time ( unix seconds )
+
 # PALT_GAIN_4100 = 0.1113501786   # this is the 4100 xducer
 # PALT_OFFSET_4100 = 3.418657     # these are average lines
 # PALT_GAIN_5100 = 0.1354567027   # this is the 5100 xducer
@@ -123,67 +172,283 @@ def read_datafile(path: str):
     with open(path, 'rb') as fp:
         data = fp.read()
 
+    return unpack_datafile(data)
+
+
+def unpack_datafile(data):
+    """ unpack and check the raw bytes of a flight data file """
+
     if len(data) != altacc_format.size:
         logging.warning(f"invalid data file length, {len(data)} bytes!")
 
-    fields = altacc_format.unpack(data)
-    flight = AltAccDump._make(fields)
+    DumpValidator().update(data).finish()
 
-    checksum = sum(data[:-4]) % 0x10000
-    if flight.CkSum != checksum:
-        raise ValueError(f"checksum mismatch datafile={flight.CkSum} computed:{checksum}")
+    return AltAccDump._make(altacc_format.unpack(data))
 
-    return flight
 
+class DumpValidator:
+    """ check a flight data transfer as it arrives.  update() takes the bytes
+    in whatever chunks they come and raises ValueError as soon as the data
+    can be seen to be corrupt ( bad header, overrun, no 'OK' ) so a download
+    can be abandoned early.  finish() raises ValueError if the transfer is
+    short or the checksum does not match
+    """
 
-def read_nitfile(path: str):
-    """ read and parse the "nit" (config) file and return as a dict """
+    def __init__(self):
+        self.received = 0
+        self.checksum = 0           # running sum of everything before CkSum
+        self.trailer = bytearray()
+        self.end_of_data = None     # sample number of the end of data marker
 
-    logging.info(f"opening nit file {path}")
+    def update(self, chunk):
+        start, end = self.received, self.received + len(chunk)
+        if end > altacc_format.size:
+            raise ValueError(f"data overrun, {end} bytes of {altacc_format.size}")
+
+        if start <= WINPTR_OFFSET < end and chunk[WINPTR_OFFSET - start] > 3:
+            raise ValueError(f"bad header, WinPtr={chunk[WINPTR_OFFSET - start]}")
+
+        if start < CKSUM_OFFSET:
+            self.checksum = (self.checksum + sum(chunk[:CKSUM_OFFSET - start])) % 0x10000
+
+        # the pressure samples are the odd bytes of Data []
+        if self.end_of_data is None and start < CKSUM_OFFSET and end > DATA_OFFSET:
+            first = max(start, DATA_OFFSET)
+            first += (first - DATA_OFFSET + 1) % 2
+            marker = bytes(chunk[first - start:CKSUM_OFFSET - start:2]).find(END_OF_DATA)
+            if marker >= 0:
+                self.end_of_data = (first - DATA_OFFSET) // 2 + marker
+
+        if end > CKSUM_OFFSET:
+            self.trailer += chunk[max(CKSUM_OFFSET - start, 0):]
+            ok = self.trailer[2:]
+            if ok != b'OK'[:len(ok)]:
+                raise ValueError(f"bad trailer, AltAcc sez {bytes(ok)!r} not 'OK'")
+
+        self.received = end
+
+        return self
+
+    @property
+    def complete(self):
+        return self.received == altacc_format.size
+
+    @property
+    def cksum(self):
+        """ the checksum the AltAcc sent or None if it has not arrived yet """
+
+        if len(self.trailer) < 2:
+            return None
+        return self.trailer[0] + (self.trailer[1] << 8)
+
+    def finish(self):
+        if not self.complete:
+            raise ValueError(f"short transfer, {self.received} bytes of {altacc_format.size}")
+
+        if self.cksum != self.checksum:
+            raise ValueError(f"checksum mismatch datafile={self.cksum} computed:{self.checksum}")
+
+        return self
+
+
+def read_header(path: str):
+    """ read only the header of a flight data file, the AltAccDump has no
+    Data, CkSum or OK so nothing past the first DATA_OFFSET bytes is read
+    """
+
+    with open(path, 'rb') as fp:
+        header = fp.read(DATA_OFFSET)
+
+    if len(header) != DATA_OFFSET:
+        raise ValueError(f"{path} is too short for an AltAcc dump, {len(header)} bytes")
+
+    return AltAccDump._make(header_format.unpack(header) + (None, None, None))
+
+
+@contextmanager
+def map_datafile(path: str, verify=False):
+    """ memory map a flight data file and unpack it in place.  Data is a
+    memoryview over the mapped file so nothing is copied and only the pages
+    actually touched are read ( numpy.frombuffer(flight.Data, 'u1') makes
+    an array of it ).  The views are only good inside the with block.  The
+    checksum covers the whole file so it is only checked if verify is set,
+    a file too short to be a dump always raises ValueError
+    """
+
+    with open(path, 'rb') as fp:
+        # an empty file cannot be mapped
+        if fp.seek(0, 2) < altacc_format.size:
+            logging.warning(f"invalid data file length, {fp.tell()} bytes!")
+            raise ValueError(f"short transfer, {fp.tell()} bytes of {altacc_format.size}")
+
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) != altacc_format.size:
+                logging.warning(f"invalid data file length, {len(mm)} bytes!")
+
+            if verify:
+                DumpValidator().update(mm).finish()
+
+            view = memoryview(mm)
+            data = view[DATA_OFFSET:DATA_OFFSET + DATA_SIZE]
+            try:
+                fields = (header_format.unpack_from(mm) + (data,) +
+                          trailer_format.unpack_from(mm, DATA_OFFSET + DATA_SIZE))
+
+                yield AltAccDump._make(fields)
+            finally:
+                data.release()
+                view.release()
+
+
+def _read_cached(path, kind, parse):
+    """ the parsed contents of a file, parsed once per distinct content.  The
+    cache is keyed by the SHA-1 of the bytes so an edited file is parsed
+    again and the same file under another name is not
+    """
+
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    key = (kind, hashlib.sha1(data).hexdigest())
+    entry = _parsed.get(key)
+    if entry is None:
+        entry = parse(key[1], data.decode())
+        if len(_parsed) >= PARSE_CACHE:
+            del _parsed[next(iter(_parsed))]    # drop the oldest
+        _parsed[key] = entry
+
+    return entry
 
+
+def _parse_nitfile(digest, text):
     nit = {}
-    with open(path) as fp:
-        for line in fp.readlines():
-            if '#' in line:
-                line, comment = line.split('#', maxsplit=1)
-            if line:
-                tag, val, *junk = line.strip().split()
-                if tag in nit_info.keys():
-                    nit[tag] = val
-                else:
-                    logging.info(f"unknown nit tag: {tag} {val}")
+    for line in text.splitlines():
+        if '#' in line:
+            line, comment = line.split('#', maxsplit=1)
+        if line.strip():
+            tag, val, *junk = line.strip().split()
+            if tag in nit_info.keys():
+                nit[tag] = val
+            else:
+                logging.info(f"unknown nit tag: {tag} {val}")
 
     # CaliData [ GainBP ].Val = PALT_GAIN_4100   ;
     # CaliData [ OffBP ].Val  = PALT_OFFSET_4100 ;
 
-    return nit
+    return tuple(nit.items())
+
+
+def _parse_calfile(digest, text):
+    tag_map = {t[0]: k for k, t in cal_info.items()}
+
+    cal = {}
+    for line in text.splitlines():
+        if '#' in line:
+            line, comment = line.split('#', maxsplit=1)
+        if line.strip():
+            tag, val, *junk = line.strip().split()
+            if tag in tag_map.keys():
+                key = tag_map[tag]
+                try:
+                    cal[key] = float(val)
+                except ValueError:
+                    cal[key] = 0.0
+                    logging.error(f"bad calibration value {tag} {val}")
+            else:
+                logging.info(f"unknown calibration tag: {tag}")
+
+    return CalFile._make((digest, tuple(cal.items())) + calibration_values(cal))
+
+
+def xducer_type(code=None):
+    """ the pressure transducer type for an XDucer code, 4100 or 5100 as a
+    float from a calibration or a string from a nit file.  MPX4100 if there
+    is none
+    """
+
+    xducer = 'MPX4100'
+    if code:
+        try:
+            code = float(code)
+        except ValueError:
+            pass
+        if code == 5100:
+            xducer = 'MPX5100'
+        elif code != 4100:
+            logging.warning(f"unknown pressure transducer {code}, assuming {xducer}")
+
+    return xducer
+
+
+def pressure_calibration(cal, xducer=None):
+    """ (GainBP, OffBP) of a calibration as produce check_calibration leaves
+    them.  A zero OffBP means the calibration did not have one and the gain
+    of the transducer is assumed.  check_calibration works out an offset
+    from ActBP too but stores it as OffBp, so OffBP stays zero
+    """
+
+    offset = cal.get('OffBP', 0.0)
+    if offset == 0.0:
+        return xducer_info[xducer or xducer_type(cal.get('XDucer'))].gain, offset
+
+    return cal.get('GainBP', 0.0), offset
+
+
+def calibration_values(cal):
+    """ (slope, zero_gee, gain, offset) the reduction uses for a calibration,
+    the accelerometer output per G ( DEFAULT_GAIN if there is no Slope ), its
+    output at zero G from the plus one G average ( None without one ) and the
+    pressure gain and offset from pressure_calibration
+    """
+
+    slope = cal.get('Slope') or DEFAULT_GAIN
+    zero_gee = cal['AvgOneG'] - slope if 'AvgOneG' in cal else None
+
+    return (slope, zero_gee) + pressure_calibration(cal)
+
+
+def read_nitfile(path: str):
+    """ read and parse the "nit" (config) file and return as a dict """
+
+    logging.info(f"opening nit file {path}")
+
+    return dict(_read_cached(path, 'nit', _parse_nitfile))
+
+
+def load_calfile(path: str):
+    """ the CalFile for a calibration file, parsed once per content.  It is
+    immutable so the cache can share it, the digest tells one calibration
+    from another whatever the file is called
+    """
+
+    logging.info(f"opening calibration file {path}")
+
+    return _read_cached(path, 'cal', _parse_calfile)
 
 
 def read_calfile(path: str):
     """ read and parse the calibration file and return as a dict """
 
-    logging.info(f"opening calibration file {path}")
+    return dict(load_calfile(path).cal)
 
-    tag_map = {t[0]: k for k, t in cal_info.items()}
 
-    cal = {}
-    with open(path) as fp:
-        for line in fp.readlines():
-            if '#' in line:
-                line, comment = line.split('#', maxsplit=1)
-            if line:
-                tag, val, *junk = line.strip().split()
-                if tag in tag_map.keys():
-                    key = tag_map[tag]
-                    try:
-                        cal[key] = float(val)
-                    except ValueError:
-                        cal[key] = 0.0
-                        logging.error(f"bad calibration value {tag} {val}")
-                else:
-                    logging.info(f"unknown calibration tag: {tag}")
-
-    return cal
+def read_sample_log(path: str, chunk_size=65536):
+    """ the start time of a sample log and an iterator of its Samples, read a
+    chunk at a time so a log of any length can be replayed
+    """
+
+    with open(path, 'rb') as fp:
+        magic, start = sample_log_header.unpack(fp.read(sample_log_header.size))
+    if magic != SAMPLE_LOG_MAGIC:
+        raise ValueError(f"{path} is not an AltAcc sample log")
+
+    def samples():
+        with open(path, 'rb') as fp:
+            fp.seek(sample_log_header.size)
+            while chunk := fp.read(chunk_size & ~1):
+                yield from map(Samples._make, zip(chunk[0::2], chunk[1::2]))
+
+    return start, samples()
 
 
 def dump_calfile(file, data):
@@ -276,3 +541,19 @@ def palt3(press, press0, cal=None):
 
     return (tropo_alt(press) - tropo_alt(press0)) * 3.2808  # converted to feet
 
+
+@lru_cache(maxsize=PALT_TABLES)
+def _palt3_table(press0, gain, offset):
+    cal = {'GainBP': gain, 'OffBP': offset}
+    return tuple(palt3(press, press0, cal) for press in range(256))
+
+
+def palt3_table(press0, cal=None):
+    """ palt3 for every pressure count 0 - 255 against press0, so a whole
+    pressure channel converts with one lookup a sample.  The tables are
+    kept per base pressure and calibration, the least used are dropped
+    """
+
+    if cal:
+        return _palt3_table(press0, cal['GainBP'], cal['OffBP'])
+    return _palt3_table(press0, 0.37037, 13.6)
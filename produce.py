@@ -2,13 +2,29 @@
 
 This Is a Python Program For Converting binary data from the BSR AltAcc
 to ASCII Data with nice little Headers.
+
+It can also be imported, nothing runs at import and matplotlib is only
+imported to graph ( see proplot, -G png or svg plots to files with no display )
+
+    cal, xducer_type = load_calibration('prodata.cal')
+    flight = load_flight('sample.dat')
+    rpt = reduce_datafile('sample.dat', flight, cal, 'prodata.cal', xducer_type)
+    text = render(rpt, fmt='C')
 """
 
+import io
+import os
 import sys
+import time
+import struct
 import argparse
-import logging
-from math import log, exp
+from collections import namedtuple
+import numpy as np
 import prodata
+import proplot
+from proreduce import DROGUE_TO_MAIN, DEFAULT_GAIN, GEE, KERNELS, reduce_flight, event_table, parse_kernels
+
+logging = prodata.lazy_import('logging')
 
 VERSION = "1.25c"
 
@@ -48,133 +64,103 @@ U = {
 }
 
 PALT_IDEAL_5100 = 210    # what _my_ test unit sez
-LAUNCH_THOLD = 16.0      # about 1/4 sec of 1.33 G
-DROGUE_TO_MAIN = 1
-DEFAULT_GAIN = 2.5500    # +/- 50 G over 255 units
-GEE = 32.17              # ft/sec^2
-dT = 0.0625              # AltAcc dt 1/16sec
 
+Report = namedtuple('Report', 'data_filename cal_filename xducer_type cal slope onegee flight reduction')
+BatchRow = namedtuple('BatchRow', 'data_filename out_filename mode agl_alt maxialt apogee_time maxvel maxacc error')
 
-def parse_commandline():
-    global args, parser
 
+def kernels_arg(text):
+    try:
+        return parse_kernels(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_commandline(argv=None):
     parser = argparse.ArgumentParser(prog='produce', description=f'AltAcc data reduction program (v{VERSION})')
     parser.add_argument('-c', '--cal', default=prodata.CAL_NAME, help='calibration (probate) filename')
     parser.add_argument('-n', '--nit', default=prodata.NIT_NAME, help='override init filename')
     parser.add_argument('-f', '--data', help='AltAcc data (proread) filename')
-    parser.add_argument('-o', '--out', help='output results filename')
+    parser.add_argument('-o', '--out', help='output results filename (directory with --batch)')
+    parser.add_argument('-b', '--batch', help='reduce every .dat file in a directory or matching a glob')
+    parser.add_argument('-H', '--headers', action='store_true',
+                        help='only scan the data file headers for the flight events, no reduction')
+    parser.add_argument('-j', '--jobs', type=int, help='number of batch worker processes (default all cores)')
 
     parser.add_argument('-z', '--oneg', action='store', help='one gee override value (overrides data file one gee)')
     parser.add_argument('-g', '--gain', action='store', help='gain override (overrides cal file gain value)')
-    parser.add_argument('-F', '--fmt', action='store', default='A', help='output file format (C)SV (A)SCII')
+    parser.add_argument('-F', '--fmt', action='store', default='A', type=str.upper, choices=sorted(REPORT_FORMATS),
+                        help='output file format (A)SCII (C)SV (X) tab separated (N)umpy .npz')
+    parser.add_argument('-K', '--kernels', type=kernels_arg, default=KERNELS,
+                        help='velocity,altitude,derivative kernels (default %s)' % ','.join(KERNELS))
+    parser.add_argument('-G', '--graph', choices=('show', 'none') + proplot.PLOT_FORMATS,
+                        help='plot in a window (show, the default for one flight), to a file per flight or none')
     parser.add_argument('-m', '--nomsl', action='store_true', help='do not show MSL pressure alt along with AGL')
     parser.add_argument('-a', '--all', action='store_true', help='force all the data out, even after touchdown')
     parser.add_argument('-q', '--quiet', action='store_true', help="be quiet about it")
     parser.add_argument('--version', action='version', version=f'v{VERSION}')
     parser.add_argument('datafile', default=None, nargs='?', action='store', help='data filename')
 
-    args = parser.parse_args()
+    return parser, parser.parse_args(argv)
 
 
-def trapezoid(ptr, data, dt):
-    """I tried Simpson's rule but the noise in the accelerometer output made
-    the output less accurate than a simple trapezoid integral.  This also
-    made the 3-element array for Altitude ( s[] ) moot but it is easier
+def check_calibration(cal, cal_filename, xducer=None):
+    """ fill in what we can for an incomplete calibration and return the
+    pressure transducer type, from the calibration or else xducer ( the nit
+    file xducer entry )
     """
 
-    return (data[ptr - 1] + data[ptr]) / 2.0 * dt
+    # TODO: Version 1.25 -- use the offset from the .cal file so actbp is on
+    xducer_type = prodata.xducer_type(cal.get('XDucer') or xducer)
 
+    # Version 1.25b -- moved from Calibrate ()
+    if cal['OffBP'] == 0.00:
+        logging.info(f"Calibration file {cal_filename} did not have OffBP value!")
+        cal['GainBP'] = prodata.xducer_info[xducer_type].gain
+        logging.info(f"assuming GainBP = {cal['GainBP']} based on {xducer_type}")
 
-def simpson(ptr, data, dt):
-    return (data[ptr - 1] + 4 * data[ptr] + data[ptr + 1]) * dt / 3
+        cal['OffBp'] = cal['ActBP'] - cal['GainBP'] * cal['AvgBP']
+        logging.info(f"assuming OffBP = {cal['OffBP']} based on ActBP: {cal['ActBP']}")
 
+    if 'Slope' not in cal or cal['Slope'] == 0.0:
+        logging.error(f"Calibration file {cal_filename} did not have Slope value!")
 
-def taylor(ptr, data, dt):
-    # dt is actually dt * 12 here !!!
-    return (data[ptr - 2] - 8 * data[ptr - 1] + 8 * data[ptr + 1] - data[ptr + 2]) / dt
+    return xducer_type
 
 
-def pressure_alt(press, press_0, cal):
-    """The Motorola data sheet sez 4.5 V / 14.5 PSI which implies 4.56 V
-    at 14.7 PSI.  The unit output is 209 / 14.7 while the ideal is
-    229.5 at 14.5 ( assume 255 / 5 Unit / volt ).  This means the
-    readings are offset low 23.3 units.  PALT_OFFSET is hardcoded
-    for now to +23.3 and all readings are adjusted up by this value.
+def load_calibration(cal_filename, xducer=None):
+    """ read and check a calibration file, returns the calibration and the
+    pressure transducer type ( xducer if the calibration does not say )
     """
 
-    if press <= 0:
-        return None
-
-    p0 = press_0 * cal['GainBP'] + cal['OffBP']
-    p1 = press * cal['GainBP'] + cal['OffBP']
-    ln_dp = log(p1 / p0)
-
-    alt = (1 - exp(ln_dp / 5.2556)) / 0.00000688
-
-    return alt
-
-
-def main():
-
-    parse_commandline()
-
-    # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
-    nit = prodata.read_nitfile(args.nit)
-    print(nit)
-
-    cal_filename = args.cal or nit['cal'] or prodata.CAL_NAME
     cal = prodata.read_calfile(cal_filename)
-    print()
-    prodata.dump_calfile(None, cal)
+    return cal, check_calibration(cal, cal_filename, xducer)
 
-    data_filename = args.datafile or args.data
-    if not data_filename:
-        parser.print_help()
-        sys.exit(1)
-    flight = prodata.read_datafile(data_filename)
-    print()
-    prodata.dump_datafile(flight)
 
-    # TODO: Version 1.25 -- use the offset from the .cal file so actbp is on
-    xducer_type = 'MPX4100'
-    if 'xDucer' in cal:
-        if cal['XDucer'] == '5100':
-            xducer_type = 'MPX5100'
-        elif cal['XDucer'] == '4100':
-            xducer_type = 'MPX4100'
-
-    # Version 1.25b -- moved from Calibrate ()
-    if cal['OffBP'] == 0.00:
-        logging.info(f"Calibration file {args.cal} did not have OffBP value!")
-        cal['GainBP'] = prodata.xducer_info[xducer_type].gain
-        logging.info(f"assuming GainBP = {cal['GainBP']} based on {xducer_type}")
+def load_flight(data_filename):
+    """ read and validate an AltAcc data file """
 
-        cal['OffBp'] = cal['ActBP'] - cal['GainBP'] * cal['AvgBP']
-        logging.info(f"assuming OffBP = {cal['OffBP']} based on ActBP: {cal['ActBP']}")
+    return prodata.read_datafile(data_filename)
 
-    if 'Slope' not in cal or cal['Slope'] == 0.0:
-        logging.error(f"Calibration file {args.cal} did not have Slope value!")
 
-    if flight.Version != 0xfe:
-        ver = "AltAcc II - v2.%03d" % flight.Version
-    else:
-        ver = "AltAcc II"
+def reduce_datafile(data_filename, flight, cal, cal_filename, xducer_type, gain=None, oneg=None, all_data=False,
+                    kernels=KERNELS):
+    """ reduce a flight with the calibration.  gain and oneg override the
+    calibration slope and the data file one gee, all_data keeps the data
+    after touchdown and kernels picks the integration and derivative kernels
+    """
 
     slope = DEFAULT_GAIN            # aka slope of curve */
-    if args.gain:
-        slope = float(args.gain)
+    if gain:
+        slope = float(gain)
     elif cal['Slope']:
         slope = cal['Slope']
 
     onegee = 0.0                    # AltAcc output @ +1 */
-    if args.oneg:
-        onegee = float(args.oneg)
+    if oneg:
+        onegee = float(oneg)
     else:
         onegee = sum(flight.Window) / 4.0
-           
-    zerogee = onegee - slope        # AltAcc output @ 0G */
-    neggee = zerogee - slope        # AltAcc output @ -1 */
-    goffset = onegee                # experimental ...   */
 
     # pre = ( byte ) floor ( CaliData [ AvgBP ].Val ) ;
     # /*
@@ -184,313 +170,402 @@ def main():
     #   palt_0 = PALT_IDEAL_5100 ;
     # */
 
-    # gather event data from flight data
-    flight_mode = flight.BSFlags & 0x01
+    reduction = reduce_flight(flight, cal, slope, onegee, all_data=all_data, kernels=kernels)
+
+    return Report._make((data_filename, cal_filename, xducer_type, cal, slope, onegee, flight, reduction))
+
 
-    def convert_time(sec, sec_16):
-        return sec + (sec_16 & 0xE0) * 8.0 + (sec_16 & 0x0F) / 16.0
+def report1(fp, rpt, com=''):
+    flight, cal, events, summary = rpt.flight, rpt.cal, rpt.reduction.events, rpt.reduction.summary
 
-    main_time = convert_time(flight.MainSec, flight.Main16s)
-    if flight_mode == DROGUE_TO_MAIN:
-        drogue_time = convert_time(flight.DrogueSec, flight.Drogue16s)
-        apogee_time = drogue_time
-        apogee_pre = flight.DroguePre
+    if flight.Version != 0xfe:
+        ver = "AltAcc II - v2.%03d" % flight.Version
     else:
-        drogue_time = None
-        apogee_time = main_time
-        apogee_pre = flight.MainPre
-
-    # Fill the time, velocity array ...
-    oacc = 0.0                           # last accel reading for Trapezoid ()
-    vel = 0.0                            # Sum of Accel == Velocity == vel
-    multiplier = dT * GEE / slope / 2    # replace slow Trap () w/ inline
-
-    tee, vee, gee, pre = [], [], [], []
-
-    # 1/4 second before launch
-    for i in range(4):
-        tee.append((i - 3) * dT)
-        vee.append(0.0)
-        pre.append(flight.BasePre)
-
-        win_ptr = (flight.WinPtr + i + 1) % 4
-        gee.append(flight.Window[win_ptr])
-
-    # oldest, older, old, cur acceleration go in next
-    for i in range(4):
-        cacc = flight.NitAcc[i] - onegee
-        vel += (oacc + cacc) * multiplier
-
-        tee.append((i + 1) * dT)
-        vee.append(vel)
-        pre.append(flight.BasePre)
-        gee.append(flight.NitAcc[i])
-
-        oacc = cacc
-
-    # Now do the flight data stored as alternating samples A P A P A P ...
-    t = 4 * dT
-    for i in range(len(flight.Data) // 2):
-        cacc = flight.Data[i * 2] - onegee
-        vel += (oacc + cacc) * multiplier
-
-        # 0.25 sec lost when firing pyros
-        if t in (main_time, drogue_time):
-            t += dT * 4
-        else:
-            t += dT
-
-        tee.append(t)
-        vee.append(vel)
-        gee.append(flight.Data[i * 2])
-        pre.append(flight.Data[i * 2 + 1])
-
-        if flight.Data[i * 2 + 1] == 254:
-            break
-
-        oacc = cacc
-
-    # Finally,  pad the end with zeros for Taylor ()
-    tee.extend((0.0, 0.0))
-    vee.extend((0.0, 0.0))
-    gee.extend((0.0, 0.0))
-    pre.extend((0.0, 0.0))
-
-    # I want to use Simpson's rule for altitude and Taylor's 2nd order
-    # 2-step derivative to back acceleration from velocity.  The simple
-    # way is to precalc the velocity into an array then work with that.
-    # Velocity is computed using the trapezoidal rule cause the data is
-    # noisy anyway. Here we go ...
-
-    oalt = 0.0  # Simpson() does 2dT
-    launch = False  # set when gsum>thold
-    atime = None  # set when gsum = 0
-    end_of_time = None  # All the data (v2)
-
-    maxialt, tmaxialt = 0.0, 0.0                 # max inertial alt   */
-    maxvel, tmaxvel = 0.0, 0.0
-    minacc, tminacc = 0.0, -1.0                  # tminacc controls derivative mode
-    maxacc, tmaxacc = 0.0, 0.0
-    minpre, tminpre = 255, 0.0
-    maxpre, tmaxpre = 0, 0.0
-    
-    acc, ialt, palt, gsum = [], [], [], []
-
-    for i, t in enumerate(tee):
-        if pre[i] == 254 or (end_of_time and t > end_of_time):
-            break
-
-        if i > 3:
-            # TODO: this seems to come out too low
-            dalt = simpson(i, vee, dT) - oalt       # differential alt
-            oalt = dalt
-            
-            ialt.append(ialt[-1] + dalt)
-            palt.append(prodata.palt3(pre[i], flight.BasePre) or 0.0)
-            acc.append(taylor(i, vee, 12 * dT))         # accel == dv/dt
-            gsum.append(gsum[-1] + gee[i] - goffset)    # goffset = onegee
-
-            if not launch and gsum[i] > LAUNCH_THOLD:
-                launch = True
-
-            if launch and gsum[i] <= 0.0 and not atime:
-                atime = t
-        else:
-            acc.append(0.0)
-            ialt.append(0.0)
-            palt.append(0.0)
-            gsum.append(0.0)
-
-        if pre[i] > maxpre:
-            maxpre = pre[i]
-            tmaxpre = t
-
-        if pre[i] <= minpre:
-            minpre = pre[i]
-            tminpre = t
-
-        if not atime or t <= atime:
-            if ialt[i] > maxialt:
-                maxialt = ialt[i]
-                tmaxialt = t
-
-            if vee[i] > maxvel:
-                maxvel = vee[i]
-                tmaxvel = t
-
-            if gsum[i] >= 0.0:
-                if acc[i] < minacc:
-                    minacc = acc[i]
-                    tminacc = t
-
-                if acc[i] > maxacc:
-                    maxacc = acc[i]
-                    tmaxacc = t
+        ver = "AltAcc II"
+
+    zerogee = rpt.onegee - rpt.slope    # AltAcc output @ 0G */
+    neggee = zerogee - rpt.slope        # AltAcc output @ -1 */
+
+    print("%s" % com, file=fp)
+    print("%sAltAcc Firmware:          %s" % (com, ver), file=fp)
+    print("%sXDucer Type:              %s" % (com, prodata.xducer_info[rpt.xducer_type].desc), file=fp)
+    print("%sFlight Mode:              %s" % (com, flight_modes[events.mode]), file=fp)
+    print("%sAltAcc Data file:         %s" % (com, rpt.data_filename), file=fp)
+    print("%sCalibration file:         %s" % (com, rpt.cal_filename), file=fp)
+    print("%s" % com, file=fp)
+    print("%sPressure Offset:       %11.4f " % (com, cal['OffBP']), file=fp)
+    print("%sPressure Gain/Slope:   %11.4f " % (com, cal['GainBP']), file=fp)
+    print("%sAltAcc Gain Factor:    %11.4f GHarrys/G" % (com, rpt.slope), file=fp)
+    print("%sAltAcc Minus One Gee:  %11.4f GHarrys" % (com, neggee), file=fp)
+    print("%sAltAcc Zero Gee:       %11.4f GHarrys" % (com, zerogee), file=fp)
+    print("%sAltAcc Plus One Gee:   %11.4f GHarrys" % (com, rpt.onegee), file=fp)
+    print("%sLaunch Site Pressure:  %6d      Orvilles" % (com, flight.BasePre), file=fp, end='')
+    if cal['OffBP'] != 0.00:
+        print("   ( %.2f in Hg )" % (flight.BasePre * cal['GainBP'] + cal['OffBP']), file=fp)
+    else:
+        print(file=fp)
+    print("%sDrogue Fire Pressure:  %6d      Orvilles" % (com, flight.DroguePre), file=fp)
+    print("%sMain Fire Pressure:    %6d      Orvilles" % (com, flight.MainPre), file=fp)
+
+    print("%sLaunch Site Altitude:  %6.0f      %s MSL" % (com, summary.alt_0, U['alt']), file=fp)
+
+    if cal['ActAlt'] >= 0.0:
+        print("%sActual Altitude:       %6.0f      %s MSL     ( Cal: ActAlt )" % (com, cal['ActAlt'],
+                                                                                  U['alt']), file=fp)
+
+    # alt_0 + CaliData [ ActAlt ].Val, Units [ U[0]] ) ;
+
+    print("%s" % com, file=fp)
+
+    if events.mode == DROGUE_TO_MAIN:
+        print("%sDrogue Fired at Time:  %11.4f %s      ( %6.0f %s AGL )" %
+              (com, events.drogue_time, U['time'], summary.drogue_alt, U['alt']), file=fp)
+    print("%sMain Fired at Time:    %11.4f %s        ( %6.0f %s AGL )" %
+          (com, events.main_time, U['time'], summary.main_alt, U['alt']), file=fp)
+
+    print("%s" % com, file=fp)
+    print("%s" % com, file=fp)
+
+
+ASCII_HEADER = (
+    "      Time  Accel  Press    Sum  Accelerat   Velocity   Altitude  PressAlt\n"
+    "       sec  units  units  units   ft/sec^2     ft/sec       feet      feet\n"
+    " =========  =====  =====  =====  =========  =========  =========  ========\n\n")
+CSV_HEADER = (
+    '''"Time","Accel","Press","Vel","Accel","Velocity","IAlt","PAlt",'''
+    '''"sec","GHarrys","Orvilles","Verns","ft/sec^2","ft/sec","feet","feet"\n''')
+
+
+def table_ascii(rpt):
+    tee, gee, pre, vee, acc, ialt, palt, gsum = map(np.ndarray.tolist, rpt.reduction.trace)
+
+    row = " %9.4f    %3d    %3d  %5.0f  %9.2f  %9.2f  %9.2f  %8.0f\n"
+    return ASCII_HEADER + ''.join(map(row.__mod__, zip(tee, gee, pre, gsum, acc, vee, ialt, palt)))
+
+
+def table_csv(rpt):
+    """ the CSV table, the inertial columns are left empty after apogee """
+
+    tee, gee, pre, vee, acc, ialt, palt, gsum = map(np.ndarray.tolist, rpt.reduction.trace)
+    atime = rpt.reduction.summary.atime
+
+    flying = "%.4f,%d,%d,%.0f,%.2f,%.2f,%.2f,%.0f\n"
+    falling = "%.4f,%d,%d,%.0f,,,,%.0f\n"
+    return CSV_HEADER + ''.join(
+        (flying % (t, g, p, s, a, v, i, pa)) if not atime or t <= atime else (falling % (t, g, p, s, pa))
+        for t, g, p, s, a, v, i, pa in zip(tee, gee, pre, gsum, acc, vee, ialt, palt))
+
+
+def table_tsv(rpt):
+    """ time, acceleration and velocity for pasting into a spreadsheet """
+
+    tee, gee, pre, vee, acc, ialt, palt, gsum = map(np.ndarray.tolist, rpt.reduction.trace)
+
+    return ''.join(f'{t}\t{g}\t{v}\n' for t, g, v in zip(tee, gee, vee))
+
+
+def table_npz(rpt):
+    """ the trace columns, events and summary as a numpy .npz archive, one
+    float64 array each and NaN for a missing value
+    """
+
+    reduction = rpt.reduction
+    arrays = {name: np.asarray(column, np.float64) for name, column in zip(reduction.trace._fields, reduction.trace)}
+    for record in (reduction.events, reduction.summary):
+        arrays.update((name, np.float64(np.nan if value is None else value))
+                      for name, value in zip(record._fields, record))
+    arrays.update(slope=np.float64(rpt.slope), onegee=np.float64(rpt.onegee))
+
+    fp = io.BytesIO()
+    np.savez(fp, **arrays)
+    return fp.getvalue()
+
+
+ReportFormat = namedtuple('ReportFormat', 'table binary ext desc')
+
+REPORT_FORMATS = {
+    'A': ReportFormat(table_ascii, False, '.rpt', 'ASCII report'),
+    'C': ReportFormat(table_csv, False, '.csv', 'CSV'),
+    'X': ReportFormat(table_tsv, False, '.tsv', 'tab separated time, accel and velocity'),
+    'N': ReportFormat(table_npz, True, '.npz', 'numpy .npz columns'),
+}
+
+
+def report2(fp, rpt, fmt='A', table=None):
+    """ write the data table in one go, table is the already rendered table
+    for fmt if there is one
+    """
+
+    fp.write(REPORT_FORMATS[fmt].table(rpt) if table is None else table)
+
+
+def report3(fp, rpt, com='# ', nomsl=False):
+    events, summary = rpt.reduction.events, rpt.reduction.summary
+    desc = 'Drogue' if events.mode == DROGUE_TO_MAIN else 'Main'
+
+    print("%s" % com, file=fp)
+    if not nomsl:
+        print("%sMSL Pressure Altitude:    %6.0f    %s         ( %9.5f sec  %s )" %
+              (com, summary.msl_alt, U['alt'], events.apogee_time, desc), file=fp)
+    print("%sAGL Pressure Altitude:    %6.0f    %s         ( %9.5f sec )" %
+          (com, summary.agl_alt, U['alt'], events.apogee_time), file=fp)
+    print("%sbiba Pressure Altitude:    %6.0f    %s         ( %9.5f sec )" %
+          (com, summary.biba_alt, U['alt'], events.apogee_time), file=fp)
+    print("%sMax Pressure Altitude:    %6.0f    %s         ( %9.5f sec )" %
+          (com, summary.maxpalt, U['alt'], summary.tminpre), file=fp)
+    print("%sMax Inertial Altitude:    %6.0f    %s         ( %9.5f sec )" %
+          (com, summary.maxialt, U['alt'], summary.tmaxialt), file=fp)
+    print("%sMaximum Velocity:         %8.1f  %s / %s   ( %9.5f sec )" %
+          (com, summary.maxvel, U['alt'], U['time'], summary.tmaxvel), file=fp)
+    print("%sMaximum Acceleration:     %9.2f %s / %s^2 ( %9.5f sec, %5.1f G's )" %
+          (com, summary.maxacc, U['alt'], U['time'], summary.tmaxacc, summary.maxacc / GEE), file=fp)
+    print("%sMinimum Acceleration:     %9.2f %s / %s^2 ( %9.5f sec, %5.1f G's )" %
+          (com, summary.minacc, U['alt'], U['time'], summary.tminacc, summary.minacc / GEE), file=fp)
+
+
+def report(fp, rpt, fmt='A', nomsl=False, table=None):
+    """ write the whole results file for one flight, headers only for (A)SCII """
+
+    fp.write(render(rpt, fmt, nomsl, table))
+
+
+def write_report(path, rpt, fmt='A', nomsl=False, table=None):
+    """ write the results file for one flight """
+
+    with open(path, 'wb' if REPORT_FORMATS[fmt].binary else 'w') as outf:
+        report(outf, rpt, fmt, nomsl, table)
+
+
+def render(rpt, fmt='A', nomsl=False, table=None):
+    """ the results file for one flight, bytes for a binary format """
+
+    if REPORT_FORMATS[fmt].binary:
+        return REPORT_FORMATS[fmt].table(rpt) if table is None else table
+
+    fp = io.StringIO()
+    if fmt == 'A':
+        report1(fp, rpt, "# ")
+    report2(fp, rpt, fmt, table)
+    if fmt == 'A':
+        report3(fp, rpt, nomsl=nomsl)
+    return fp.getvalue()
+
+
+def graph(rpt, fmt='show', path=None):
+    """ plot a flight in a window ( show ) or to a PNG or SVG file, path
+    defaults to the data filename with the format as the extension
+    """
+
+    if fmt == 'show':
+        proplot.show(rpt)
+    elif fmt in proplot.PLOT_FORMATS:
+        proplot.save(rpt, path or proplot.plot_path(rpt.data_filename, fmt=fmt))
+
+
+def batch_files(spec):
+    """ the data files for a batch, every .dat in a directory or a glob """
+
+    import glob
+
+    if os.path.isdir(spec):
+        spec = os.path.join(spec, '*.dat')
+
+    return sorted(glob.glob(spec))
+
+
+def batch_init(cal, cal_filename, xducer_type, options):
+    """ pool initializer, each worker gets the parsed calibration once """
+
+    global batch_options, batch_cal
+
+    batch_options = options
+    batch_cal = (cal, cal_filename, xducer_type)
+
+
+def batch_flight(data_filename):
+    """ reduce one flight of a batch and write its report """
+
+    cal, cal_filename, xducer_type = batch_cal
+    options = batch_options
+
+    stem = os.path.splitext(os.path.basename(data_filename))[0]
+    out_dir = options.out or os.path.dirname(data_filename)
+    out_filename = os.path.join(out_dir, stem + REPORT_FORMATS[options.fmt].ext)
+
+    try:
+        # the flight is reduced straight from the mapped file, the report must not outlive it
+        with prodata.map_datafile(data_filename, verify=True) as flight:
+            rpt = reduce_datafile(data_filename, flight, cal, cal_filename, xducer_type, options.gain, options.oneg,
+                                  options.all, options.kernels)
+            write_report(out_filename, rpt, options.fmt, options.nomsl)
+            if options.graph in proplot.PLOT_FORMATS:
+                graph(rpt, options.graph, proplot.plot_path(data_filename, options.out, options.graph))
+    except (ValueError, struct.error, OSError, ImportError) as e:
+        return BatchRow._make((data_filename, None, None, None, None, None, None, None, str(e)))
+
+    events, summary = rpt.reduction.events, rpt.reduction.summary
+
+    return BatchRow._make((data_filename, out_filename, events.mode, summary.agl_alt, summary.maxialt,
+                           events.apogee_time, summary.maxvel, summary.maxacc, None))
+
+
+def report_batch(fp, rows, elapsed):
+    print("%-24s  %-6s  %8s  %8s  %9s  %8s  %9s  %5s" %
+          ("Flight", "Mode", "Apogee", "IAlt", "Time", "MaxVel", "MaxAcc", "G's"), file=fp)
+    print("%-24s  %-6s  %8s  %8s  %9s  %8s  %9s  %5s" %
+          ("", "", U['alt'] + " AGL", U['alt'], U['time'], U['alt'] + "/" + U['time'],
+           U['alt'] + "/" + U['time'] + "^2", ""), file=fp)
+    print("%s  %s  %s  %s  %s  %s  %s  %s" %
+          ("=" * 24, "=" * 6, "=" * 8, "=" * 8, "=" * 9, "=" * 8, "=" * 9, "=" * 5), file=fp)
+
+    for row in rows:
+        name = os.path.basename(row.data_filename)
+        if row.error:
+            print("%-24s  *** %s" % (name, row.error), file=fp)
         else:
-            # (v2) -- Break early if we get back to the ground
-            if not args.all and pre[i] >= flight.BasePre and not end_of_time:
-                end_of_time = t + 5.0  # Add 5 seconds
-
-    # v1.25 */
-    # compute pressure for ideal sea level 29.921 inHg TODO: cal is in kPa!
-    palt_0 = (29.921 - cal['OffBP']) / cal['GainBP']
-    # launch site alt
-    alt_0 = pressure_alt(flight.BasePre, palt_0, cal)
-
-    agl_alt = pressure_alt(apogee_pre, flight.BasePre, cal)
-    msl_alt = pressure_alt(apogee_pre, palt_0, cal) - alt_0
-    main_alt = pressure_alt(flight.MainPre, flight.BasePre, cal)
-    drogue_alt = pressure_alt(flight.DroguePre, flight.BasePre, cal)
-    maxpalt = pressure_alt(minpre, flight.BasePre, cal)
-    biba_alt = prodata.palt3(apogee_pre, flight.BasePre)
-    
-    def report1(fp, com=''):
-        print("%s" % com, file=fp)
-        print("%sAltAcc Firmware:          %s" % (com, ver), file=fp)
-        print("%sXDucer Type:              %s" % (com, prodata.xducer_info[xducer_type].desc), file=fp)
-        print("%sFlight Mode:              %s" % (com, flight_modes[flight_mode]), file=fp)
-        print("%sAltAcc Data file:         %s" % (com, data_filename), file=fp)
-        print("%sCalibration file:         %s" % (com, cal_filename), file=fp)
-        print("%s" % com, file=fp)
-        print("%sPressure Offset:       %11.4f " % (com, cal['OffBP']), file=fp)
-        print("%sPressure Gain/Slope:   %11.4f " % (com, cal['GainBP']), file=fp)
-        print("%sAltAcc Gain Factor:    %11.4f GHarrys/G" % (com, slope), file=fp)
-        print("%sAltAcc Minus One Gee:  %11.4f GHarrys" % (com, neggee), file=fp)
-        print("%sAltAcc Zero Gee:       %11.4f GHarrys" % (com, zerogee), file=fp)
-        print("%sAltAcc Plus One Gee:   %11.4f GHarrys" % (com, onegee), file=fp)
-        print("%sLaunch Site Pressure:  %6d      Orvilles" % (com, flight.BasePre), file=fp, end='')
-        if cal['OffBP'] != 0.00:
-            print("   ( %.2f in Hg )" % (flight.BasePre * cal['GainBP'] + cal['OffBP']), file=fp)
+            desc = 'Drogue' if row.mode == DROGUE_TO_MAIN else 'Main'
+            print("%-24s  %-6s  %8.0f  %8.0f  %9.4f  %8.1f  %9.2f  %5.1f" %
+                  (name, desc, row.agl_alt, row.maxialt, row.apogee_time, row.maxvel, row.maxacc, row.maxacc / GEE),
+                  file=fp)
+
+    print(file=fp)
+    print("reduced %d flights in %.2f sec ( %.1f flights/sec )" %
+          (len(rows), elapsed, len(rows) / elapsed if elapsed else 0.0), file=fp)
+
+
+def scan_events(paths, cal=None):
+    """ (data_filename, EventTable, error) for each data file read from its
+    header alone, this runs at the speed of the disk
+    """
+
+    rows = []
+    for path in paths:
+        try:
+            rows.append((path, event_table(prodata.read_header(path), cal), None))
+        except (ValueError, struct.error, OSError) as e:
+            rows.append((path, None, str(e)))
+
+    return rows
+
+
+def report_events(fp, rows, elapsed):
+    print("%-24s  %3s  %-6s  %9s  %8s  %9s  %8s  %9s  %8s" %
+          ("Flight", "Ver", "Mode", "Drogue", "Drogue", "Main", "Main", "Apogee", "Apogee"), file=fp)
+    print("%-24s  %3s  %-6s  %9s  %8s  %9s  %8s  %9s  %8s" %
+          ("", "", "", U['time'], U['alt'] + " AGL", U['time'], U['alt'] + " AGL", U['time'], U['alt'] + " AGL"),
+          file=fp)
+    print("%s  %s  %s  %s  %s  %s  %s  %s  %s" %
+          ("=" * 24, "=" * 3, "=" * 6, "=" * 9, "=" * 8, "=" * 9, "=" * 8, "=" * 9, "=" * 8), file=fp)
+
+    def alt(value):
+        return "%8s" % '-' if value is None else "%8.0f" % value
+
+    for data_filename, events, error in rows:
+        name = os.path.basename(data_filename)
+        if error:
+            print("%-24s  *** %s" % (name, error), file=fp)
         else:
-            print(file=fp)
-        print("%sDrogue Fire Pressure:  %6d      Orvilles" % (com, flight.DroguePre), file=fp)
-        print("%sMain Fire Pressure:    %6d      Orvilles" % (com, flight.MainPre), file=fp)
+            desc = 'Drogue' if events.mode == DROGUE_TO_MAIN else 'Main'
+            drogue = "%9s" % '-' if events.drogue_time is None else "%9.4f" % events.drogue_time
+            print("%-24s  %3d  %-6s  %s  %s  %9.4f  %s  %9.4f  %s" %
+                  (name, events.version, desc, drogue, alt(events.drogue_alt), events.main_time,
+                   alt(events.main_alt), events.apogee_time, alt(events.agl_alt)), file=fp)
+
+    print(file=fp)
+    print("scanned %d flights in %.2f sec ( %.1f flights/sec )" %
+          (len(rows), elapsed, len(rows) / elapsed if elapsed else 0.0), file=fp)
+
+
+def batch(cal, cal_filename, xducer_type, options):
+    """ reduce a whole directory of flights across a process pool, options
+    are the parsed command line
+    """
 
-        print("%sLaunch Site Altitude:  %6.0f      %s MSL" % (com, alt_0, U['alt']), file=fp)
+    from concurrent.futures import ProcessPoolExecutor
 
-        if cal['ActAlt'] >= 0.0:
-            print("%sActual Altitude:       %6.0f      %s MSL     ( Cal: ActAlt )" % (com, cal['ActAlt'],
-                                                                                      U['alt']), file=fp)
-            
-        # alt_0 + CaliData [ ActAlt ].Val, Units [ U[0]] ) ;
+    paths = batch_files(options.batch)
+    if not paths:
+        print(f"no data files found for {options.batch}")
+        return 1
 
-        print("%s" % com, file=fp)
+    if options.out:
+        os.makedirs(options.out, exist_ok=True)
 
-        if flight_mode == DROGUE_TO_MAIN:
-            print("%sDrogue Fired at Time:  %11.4f %s      ( %6.0f %s AGL )" %
-                  (com, drogue_time, U['time'], drogue_alt, U['alt']), file=fp)
-        print("%sMain Fired at Time:    %11.4f %s        ( %6.0f %s AGL )" %
-              (com, main_time, U['time'], main_alt, U['alt']), file=fp)
+    jobs = options.jobs or os.cpu_count()
+    chunk = max(1, len(paths) // (jobs * 4))
 
-        print("%s" % com, file=fp)
-        print("%s" % com, file=fp)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=batch_init,
+                             initargs=(cal, cal_filename, xducer_type, options)) as pool:
+        rows = list(pool.map(batch_flight, paths, chunksize=chunk))
+    elapsed = time.perf_counter() - start
+
+    report_batch(sys.stdout, rows, elapsed)
+
+    return 1 if any(row.error for row in rows) else 0
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+
+    # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
+    nit = prodata.read_nitfile(args.nit)
+    print(nit)
+
+    cal_filename = args.cal or nit['cal'] or prodata.CAL_NAME
+    cal = prodata.read_calfile(cal_filename)
+    print()
+    prodata.dump_calfile(None, cal)
+
+    xducer_type = check_calibration(cal, cal_filename, nit.get('xducer'))
+
+    data_filename = args.datafile or args.data
+    if args.headers:
+        paths = batch_files(args.batch) if args.batch else [data_filename] if data_filename else []
+        if not paths:
+            print(f"no data files found for {args.batch}")
+            return 1
+
+        start = time.perf_counter()
+        rows = scan_events(paths, cal)
+        report_events(sys.stdout, rows, time.perf_counter() - start)
+        return 1 if any(error for path, events, error in rows) else 0
+
+    if args.batch:
+        return batch(cal, cal_filename, xducer_type, args)
+
+    if not data_filename:
+        parser.print_help()
+        return 1
+    flight = load_flight(data_filename)
+    print()
+    prodata.dump_datafile(flight)
+
+    rpt = reduce_datafile(data_filename, flight, cal, cal_filename, xducer_type, args.gain, args.oneg, args.all,
+                          args.kernels)
+
+    # the table is rendered once for the results file and the screen
+    fmt = REPORT_FORMATS[args.fmt]
+    table = fmt.table(rpt)
 
     if args.out:
-        outf = open(args.out, 'w')
-        if args.fmt == 'A':
-            report1(outf, "# ")
-            
+        write_report(args.out, rpt, args.fmt, args.nomsl, table)
+
+    out = io.StringIO()
     if not args.quiet:
-        report1(sys.stdout)
-
-    def report2(fp):
-        if args.fmt == 'A':
-            print(
-                "      Time  Accel  Press    Sum  Accelerat   Velocity   Altitude  PressAlt\n"
-                "       sec  units  units  units   ft/sec^2     ft/sec       feet      feet\n"
-                " =========  =====  =====  =====  =========  =========  =========  ========\n",
-                file=fp)
-        else:
-            print(
-                '''"Time","Accel","Press","Vel","Accel","Velocity","IAlt","PAlt",'''
-                '''"sec","GHarrys","Orvilles","Verns","ft/sec^2","ft/sec","feet","feet"''',
-                file=fp)
-
-        for i, t in enumerate(tee):
-            if t > end_of_time:
-                break
-
-            if args.fmt == 'A':
-                print(" %9.4f    %3d    %3d  %5.0f  %9.2f  %9.2f  %9.2f  %8.0f" %
-                      (t, gee[i], pre[i], gsum[i], acc[i], vee[i], ialt[i], palt[i]), file=fp)
-            elif args.fmt == 'X':
-                print(f'{t}\t{gee[i]}\t{vee[i]}')
-            else:
-                print("%.4f,%d,%d,%.0f," %
-                      (t, gee[i], pre[i], gsum[i]), end='', file=fp)
-                if t <= atime:
-                    print("%.2f,%.2f,%.2f,%.0f" % (acc[i], vee[i], ialt[i], palt[i]), file=fp)
-                else:
-                    print(",,,%.0f" % palt[i], file=fp)
+        report1(out, rpt)
+    report2(out, rpt, 'A' if fmt.binary else args.fmt, None if fmt.binary else table)
+    report3(out, rpt, com='', nomsl=args.nomsl)
+    sys.stdout.write(out.getvalue())
 
-    if args.out:
-        report2(outf)
-    report2(sys.stdout)
-    
-    def report3(fp, com='# '):
-        desc = 'Drogue' if flight_mode == DROGUE_TO_MAIN else 'Main'
-        
-        print("%s" % com, file=fp)
-        if not args.nomsl:
-            print("%sMSL Pressure Altitude:    %6.0f    %s         ( %9.5f sec  %s )" %
-                  (com, msl_alt, U['alt'], apogee_time, desc), file=fp)
-        print("%sAGL Pressure Altitude:    %6.0f    %s         ( %9.5f sec )" %
-              (com, agl_alt, U['alt'], apogee_time), file=fp)
-        print("%sbiba Pressure Altitude:    %6.0f    %s         ( %9.5f sec )" %
-              (com, biba_alt, U['alt'], apogee_time), file=fp)
-        print("%sMax Pressure Altitude:    %6.0f    %s         ( %9.5f sec )" %
-              (com, maxpalt, U['alt'], tminpre), file=fp)
-        print("%sMax Inertial Altitude:    %6.0f    %s         ( %9.5f sec )" %
-              (com, maxialt, U['alt'], tmaxialt), file=fp)
-        print("%sMaximum Velocity:         %8.1f  %s / %s   ( %9.5f sec )" %
-              (com, maxvel, U['alt'], U['time'], tmaxvel), file=fp)
-        print("%sMaximum Acceleration:     %9.2f %s / %s^2 ( %9.5f sec, %5.1f G's )" %
-              (com, maxacc, U['alt'], U['time'], tmaxacc, maxacc / GEE), file=fp)
-        print("%sMinimum Acceleration:     %9.2f %s / %s^2 ( %9.5f sec, %5.1f G's )" %
-              (com, minacc, U['alt'], U['time'], tminacc, minacc / GEE), file=fp)
-
-    def graph():
-        import matplotlib.pyplot as plt
-
-        # x = np.arange(0, DAYS)
-        points = int(atime * 16)
-
-        t = tee[:points]
-        g = [(x - onegee) / slope for x in gee[:points]]
-        # smooth the pressure data
-        p = [sum(palt[i: i + 4]) / 4 for i in range(len(palt))]
-        
-        plt.suptitle(data_filename)
-
-        plt.subplot(221)
-        plt.plot(t, g)
-        plt.legend(['acc G'], loc='upper right')
-        plt.xlabel('sec')
-        plt.ylabel('G')
-        
-        plt.subplot(223)
-        plt.plot(t, vee[:points], color='g')
-        plt.plot(t, ialt[:points], color='r')
-        plt.plot(t, palt[:points], color='r')
-        plt.legend(['vel ft/sec', 'alt ft'], loc='upper left')
-        plt.xlabel('sec')
-        
-        plt.subplot(222)
-        plt.title('Pressure Altitude')
-        plt.plot(tee[:len(p)], p, color='r')
-        plt.ylim(ymin=-5)
-        # plt.legend(['alt'], loc='upper right')
-        plt.xlabel('sec')
-        plt.xlim(xmin=-0.25)
-        
-        plt.show()
+    if args.graph in proplot.PLOT_FORMATS:
+        graph(rpt, args.graph, proplot.plot_path(args.out or data_filename, fmt=args.graph))
+    elif args.graph != 'none':
+        graph(rpt)
 
-    if args.out:
-        if args.fmt == 'A':
-            report3(outf)
-        outf.close()
-    report3(sys.stdout, com='')
+    return 0
 
-    graph()
 
-main()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+""" proplot
+
+These are the flight plots for the BSR AltAcc software.
+
+matplotlib is only imported when a plot is actually drawn.  Plot files
+( PNG or SVG ) are drawn on a bare Figure with the Agg backend so nothing
+needs a display or blocks on a window, which makes them safe to draw from
+batch worker processes.  The traces are decimated to about PLOT_POINTS
+points before plotting, keeping the minimum and maximum of each stretch so
+the peaks survive.
+"""
+
+import os
+
+PLOT_POINTS = 1000          # points drawn for a trace, about
+PLOT_FORMATS = ('png', 'svg')
+
+
+def decimate(tee, values, points=PLOT_POINTS):
+    """ (t, v) lists of about points samples with the min and max of every
+    stretch of samples in time order
+    """
+
+    n = min(len(tee), len(values))
+    if n <= points:
+        return list(tee[:n]), list(values[:n])
+
+    size = -(-n // (points // 2))
+    t, v = [], []
+    for start in range(0, n, size):
+        stretch = range(start, min(start + size, n))
+        lo = min(stretch, key=values.__getitem__)
+        hi = max(stretch, key=values.__getitem__)
+        for i in sorted({lo, hi}):
+            t.append(tee[i])
+            v.append(values[i])
+
+    return t, v
+
+
+def draw(fig, rpt, points=PLOT_POINTS):
+    """ draw the flight of a produce Report on a matplotlib Figure """
+
+    tee, gee, pre, vee, acc, ialt, palt, gsum = rpt.reduction.trace
+
+    # the inertial traces are only good up to apogee
+    atime = rpt.reduction.summary.atime
+    w = int(tee.searchsorted(atime, 'right')) if atime else len(tee)
+    t = tee[:w]
+    g = (gee[:w] - rpt.onegee) / rpt.slope
+    # smooth the pressure data
+    p = [sum(palt[i: i + 4]) / 4 for i in range(len(palt))]
+
+    fig.suptitle(rpt.data_filename)
+
+    ax = fig.add_subplot(221)
+    ax.plot(*decimate(t, g, points))
+    ax.legend(['acc G'], loc='upper right')
+    ax.set_xlabel('sec')
+    ax.set_ylabel('G')
+
+    ax = fig.add_subplot(223)
+    ax.plot(*decimate(t, vee[:w], points), color='g')
+    ax.plot(*decimate(t, ialt[:w], points), color='r')
+    ax.plot(*decimate(t, palt[:w], points), color='r')
+    ax.legend(['vel ft/sec', 'alt ft'], loc='upper left')
+    ax.set_xlabel('sec')
+
+    ax = fig.add_subplot(222)
+    ax.set_title('Pressure Altitude')
+    ax.plot(*decimate(tee, p, points), color='r')
+    ax.set_ylim(bottom=-5)
+    ax.set_xlabel('sec')
+    ax.set_xlim(left=-0.25)
+
+    return fig
+
+
+def show(rpt, points=PLOT_POINTS):
+    """ plot a flight in a window and wait for it to be closed """
+
+    import matplotlib.pyplot as plt
+
+    draw(plt.figure(), rpt, points)
+    plt.show()
+
+
+def save(rpt, path, points=PLOT_POINTS):
+    """ plot a flight to a PNG or SVG file, the format is from the extension """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(10, 7.5))
+    FigureCanvasAgg(fig)
+    draw(fig, rpt, points)
+    fig.savefig(path)
+
+    return path
+
+
+def plot_path(data_filename, out_dir=None, fmt='png'):
+    """ the plot filename for a data file, next to it unless out_dir """
+
+    stem = os.path.splitext(os.path.basename(data_filename))[0]
+    return os.path.join(out_dir or os.path.dirname(data_filename), f"{stem}.{fmt}")
@@ -0,0 +1,404 @@
+""" proquery
+
+This program answers questions about the flights in an archive ( see
+proarch ) without reducing them again, e.g. the top 20 accelerations of the
+MPX5100 units flown drogue to main
+
+    proquery flights.arch -w xducer=MPX5100 -w mode=1 -t 20 -s maxacc
+
+or the average apogee of each firmware version
+
+    proquery flights.arch -g Version -a count,mean:agl_alt,max:agl_alt
+
+The questions are answered from a summary table of every flight, one typed
+array a column: the header fields, the transducer of the calibration it was
+reduced with, the event times and the summary of its stored reduction ( NaN
+where it has none ).  The transducer is the calibration file XDucer or else
+the nit file xducer.  The table is kept next to the archive ( ARCHIVE.summary )
+and only built again when the archive, its reductions, the contents of their
+calibration files or the nit xducer change.  A filter is one pass over a
+column and the rows that pass every filter are picked out with compress,
+top-N is a heap over just those rows.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import heapq
+import struct
+import argparse
+from array import array
+from itertools import compress, repeat
+from collections import namedtuple
+from operator import eq, ne, lt, le, gt, ge
+import prodata
+import proreduce
+import proarch
+
+logging = prodata.lazy_import('logging')
+
+VERSION = "1.25c"
+
+SUMMARY_EXT = '.summary'
+SUMMARY_MAGIC = b'ALTACCST'
+SUMMARY_FORMAT = 2
+summary_header = struct.Struct("<8sHII")        # magic, format, count, json length
+
+HEADER_COLUMNS = ('Version', 'BSFlags', 'mode', 'BasePre', 'apogee_pre')
+EVENT_COLUMNS = ('main_time', 'drogue_time', 'apogee_time')
+SUMMARY_COLUMNS = proreduce.FlightSummary._fields
+METRIC_COLUMNS = EVENT_COLUMNS + SUMMARY_COLUMNS
+COLUMNS = HEADER_COLUMNS + ('xducer', 'reduced') + METRIC_COLUMNS
+DEFAULT_FIELDS = ('Version', 'mode', 'xducer', 'agl_alt', 'maxialt', 'maxvel', 'maxacc')
+
+OPERATORS = {'=': eq, '==': eq, '!=': ne, '<': lt, '<=': le, '>': gt, '>=': ge}
+AGGREGATES = ('count', 'sum', 'mean', 'std', 'min', 'max')
+
+Condition = namedtuple('Condition', 'field op value')
+
+
+class SummaryTable:
+    """ the per flight summary columns of an archive.  xducer is stored as a
+    code into the xducers list, everything else as its value
+    """
+
+    def __init__(self, ids, columns, xducers, stamp=None):
+        self.ids = ids
+        self.columns = columns
+        self.xducers = xducers
+        self.stamp = stamp
+
+    def __len__(self):
+        return len(self.ids)
+
+    def column(self, name):
+        if name not in self.columns:
+            raise ValueError(f"no column {name}, pick from {', '.join(COLUMNS)}")
+        return self.columns[name]
+
+    def value(self, name, row):
+        value = self.column(name)[row]
+        return self.xducers[value] if name == 'xducer' else value
+
+    @classmethod
+    def build(cls, path, xducer=None):
+        """ a table from the archive headers and its stored reductions, xducer
+        is the transducer for calibrations that do not say ( nit xducer )
+        """
+
+        entries = proarch.read_reductions(path)
+        xducers = []
+        xducer_of = {}
+
+        columns = {name: array('B') for name in HEADER_COLUMNS + ('xducer', 'reduced')}
+        columns.update((name, array('d')) for name in METRIC_COLUMNS)
+        nan = float('nan')
+
+        with proarch.FlightArchive(path) as arch:
+            ids = list(arch.ids)
+            for row, flight_id in enumerate(ids):
+                flight = arch.header(row)
+                events = proreduce.flight_events(flight)
+                for name, value in zip(HEADER_COLUMNS, (flight.Version, flight.BSFlags, events.mode, flight.BasePre,
+                                                        events.apogee_pre)):
+                    columns[name].append(value)
+                for name in EVENT_COLUMNS:
+                    value = getattr(events, name)
+                    columns[name].append(nan if value is None else value)
+
+                entry = entries.get(flight_id)
+                if entry is None:
+                    xducer_type = ''
+                    metrics = repeat(nan, len(SUMMARY_COLUMNS))
+                else:
+                    if entry['cal'] not in xducer_of:
+                        xducer_of[entry['cal']] = _xducer(entry['cal'], xducer)
+                    xducer_type = xducer_of[entry['cal']]
+                    metrics = (nan if v is None else v for v in entry['summary'])
+
+                if xducer_type not in xducers:
+                    xducers.append(xducer_type)
+                columns['xducer'].append(xducers.index(xducer_type))
+                columns['reduced'].append(entry is not None)
+                for name, value in zip(SUMMARY_COLUMNS, metrics):
+                    columns[name].append(value)
+
+        return cls(ids, columns, xducers, _stamp(path, xducer_of, xducer))
+
+    def save(self, path):
+        meta = json.dumps({'ids': self.ids, 'xducers': self.xducers, 'stamp': self.stamp,
+                           'columns': [(name, column.typecode) for name, column in self.columns.items()]}).encode()
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(summary_header.pack(SUMMARY_MAGIC, SUMMARY_FORMAT, len(self.ids), len(meta)))
+            fp.write(meta)
+            for column in self.columns.values():
+                if sys.byteorder == 'big':
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                fp.write(column.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+
+        magic, fmt, count, size = summary_header.unpack_from(data)
+        if magic != SUMMARY_MAGIC or fmt != SUMMARY_FORMAT:
+            raise ValueError(f"{path} is not an AltAcc summary table")
+
+        offset = summary_header.size
+        meta = json.loads(data[offset:offset + size])
+        offset += size
+
+        columns = {}
+        for name, typecode in meta['columns']:
+            column = array(typecode)
+            column.frombytes(data[offset:offset + count * column.itemsize])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns[name] = column
+            offset += count * column.itemsize
+
+        return cls(meta['ids'], columns, meta['xducers'], meta['stamp'])
+
+
+def _xducer(cal_filename, xducer=None):
+    """ the pressure transducer of a calibration file or '' if it is gone """
+
+    from produce import load_calibration
+
+    try:
+        return load_calibration(cal_filename, xducer)[1]
+    except OSError:
+        return ''
+
+
+def _digest(cal_filename):
+    try:
+        return prodata.load_calfile(cal_filename).digest
+    except OSError:
+        return None
+
+
+def _stamp(path, cal_filenames, xducer):
+    """ what the table was built from, the archive and reductions as they
+    were, the contents of the calibration files and the nit xducer
+    """
+
+    files = []
+    for name in (path, proarch.reductions_path(path)):
+        try:
+            st = os.stat(name)
+            files.append([st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            files.append(None)
+
+    return {'files': files, 'cals': {name: _digest(name) for name in sorted(cal_filenames)}, 'xducer': xducer}
+
+
+def summary_path(path):
+    return path + SUMMARY_EXT
+
+
+def summary_table(path, xducer=None):
+    """ the summary table of an archive, built again only if what it was
+    built from ( see _stamp ) has changed since it was saved
+    """
+
+    try:
+        table = SummaryTable.load(summary_path(path))
+        if table.stamp == _stamp(path, table.stamp['cals'], xducer):
+            return table
+    except (OSError, ValueError, KeyError, struct.error):
+        pass
+
+    table = SummaryTable.build(path, xducer)
+    try:
+        table.save(summary_path(path))
+    except OSError as e:
+        logging.warning(f"summary table not saved: {e}")
+
+    return table
+
+
+def parse_condition(text):
+    """ a Condition from 'field op value', e.g. maxacc>=300 or xducer=MPX5100 """
+
+    m = re.fullmatch(r'\s*(\w+)\s*(==|=|!=|<=|>=|<|>)\s*(.+?)\s*', text)
+    if not m:
+        raise ValueError(f"cannot make sense of {text}, expected e.g. maxacc>300")
+
+    field, op, value = m.groups()
+    if field not in COLUMNS:
+        raise ValueError(f"no column {field}, pick from {', '.join(COLUMNS)}")
+    if field != 'xducer':
+        value = float(value)
+
+    return Condition._make((field, OPERATORS[op], value))
+
+
+def select(table, conditions):
+    """ the rows that pass every condition """
+
+    mask = None
+    for cond in conditions:
+        column = table.column(cond.field)
+        value = cond.value
+        if cond.field == 'xducer':
+            # compare the codes, a transducer never seen matches nothing ( or everything for != )
+            value = table.xducers.index(value) if value in table.xducers else -1
+        passed = map(cond.op, column, repeat(value))
+        mask = list(passed) if mask is None else [a and b for a, b in zip(mask, passed)]
+
+    return list(range(len(table))) if mask is None else list(compress(range(len(table)), mask))
+
+
+def top(table, rows, field, n, ascending=False):
+    """ the n rows with the largest ( or smallest ) field, rows with no value left out """
+
+    column = table.column(field)
+    rows = [row for row in rows if not math.isnan(column[row])]
+    pick = heapq.nsmallest if ascending else heapq.nlargest
+    return pick(n, rows, key=column.__getitem__)
+
+
+def parse_aggregates(text):
+    """ [(aggregate, field)] from 'count,mean:maxacc,max:agl_alt' """
+
+    aggs = []
+    for spec in text.split(','):
+        agg, _, field = spec.partition(':')
+        if agg not in AGGREGATES:
+            raise ValueError(f"unknown aggregate {agg}, pick from {', '.join(AGGREGATES)}")
+        if agg != 'count' and field not in METRIC_COLUMNS + HEADER_COLUMNS:
+            raise ValueError(f"{agg} needs a column, e.g. {agg}:maxacc")
+        aggs.append((agg, field))
+    return aggs
+
+
+def aggregate(table, rows, aggs, group=None):
+    """ [(group value, [aggregate values])] over rows, one group of them all
+    when there is no group column.  NaNs ( flights not reduced ) are left out
+    """
+
+    from procal import RunningStats
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(table.value(group, row) if group else None, []).append(row)
+
+    results = []
+    for key in sorted(groups, key=lambda k: (k is None, k)):
+        values = []
+        for agg, field in aggs:
+            if agg == 'count':
+                values.append(len(groups[key]))
+                continue
+
+            column = table.column(field)
+            data = [x for x in map(column.__getitem__, groups[key]) if not math.isnan(x)]
+            if not data:
+                values.append(float('nan'))
+            elif agg in ('mean', 'std'):
+                stats = RunningStats().extend(data)
+                values.append(stats.mean if agg == 'mean' else stats.std)
+            else:
+                values.append({'sum': math.fsum, 'min': min, 'max': max}[agg](data))
+        results.append((key, values))
+
+    return results
+
+
+def _format(value):
+    if isinstance(value, str):
+        return "%9s" % value
+    if isinstance(value, float):
+        return "%9s" % '-' if math.isnan(value) else "%9.2f" % value
+    return "%9d" % value
+
+
+def condition_arg(text):
+    try:
+        return parse_condition(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def aggregates_arg(text):
+    try:
+        return parse_aggregates(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='proquery', description=f'AltAcc flight archive queries (v{VERSION})')
+    parser.add_argument('-w', '--where', type=condition_arg, action='append', default=[],
+                        help='FIELD OP VALUE filter, repeat for more, e.g. -w mode=1 -w "maxacc>300"')
+    parser.add_argument('-s', '--sort', help='field to rank the flights by (largest first)')
+    parser.add_argument('-t', '--top', type=int, help='only the first N flights')
+    parser.add_argument('--ascending', action='store_true', help='rank smallest first')
+    parser.add_argument('-f', '--fields', default=','.join(DEFAULT_FIELDS), help='comma separated fields to list')
+    parser.add_argument('-g', '--group', help='field to group the aggregates by')
+    parser.add_argument('-a', '--agg', type=aggregates_arg, help='aggregates, e.g. count,mean:maxacc,max:agl_alt')
+    parser.add_argument('-c', '--cal', help='reduce flights with no stored reduction with this calibration first')
+    parser.add_argument('-n', '--nit', default=prodata.NIT_NAME,
+                        help='init filename, its xducer is used for calibrations without one')
+    parser.add_argument('--version', action='version', version=f'v{VERSION}')
+    parser.add_argument('archive', help='archive filename')
+
+    return parser, parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+
+    try:
+        nit = prodata.read_nitfile(args.nit)
+    except FileNotFoundError:
+        nit = {}
+
+    try:
+        table = summary_table(args.archive, nit.get('xducer'))
+        if args.cal:
+            missing = list(compress(table.ids, (not r for r in table.column('reduced'))))
+            if missing:
+                print(f"reducing {len(missing)} flights with {args.cal}")
+                proarch.rereduce(args.archive, args.cal, missing)
+                table = summary_table(args.archive, nit.get('xducer'))
+
+        rows = select(table, args.where)
+
+        if args.agg or args.group:
+            aggs = args.agg or [('count', '')]
+            names = [agg if agg == 'count' else f"{agg}:{field}" for agg, field in aggs]
+            print("  ".join(["%9s" % (args.group or '')] + ["%9s" % name[:9] for name in names]))
+            for key, values in aggregate(table, rows, aggs, args.group):
+                print("  ".join([_format('all' if key is None else key)] + [_format(v) for v in values]))
+            return 0
+
+        if args.sort:
+            rows = top(table, rows, args.sort, args.top or len(rows), args.ascending)
+        elif args.top:
+            rows = rows[:args.top]
+
+        fields = [f for f in args.fields.split(',') if f]
+        print("  ".join(["%-24s" % "Flight"] + ["%9s" % f[:9] for f in fields]))
+        for row in rows:
+            print("  ".join(["%-24s" % table.ids[row]] + [_format(table.value(f, row)) for f in fields]))
+        print(f"{len(rows)} of {len(table)} flights")
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,123 +1,398 @@
 """                                produce
 
 This program is to download the BSR AltAcc flight data to a file
+
+The AltAcc can only send its whole memory ( /R ) so a bad transfer is
+mended by asking for it again.  The dump is kept as BLOCK byte blocks and
+every version of a block that arrives is counted.  The dump is put together
+from the version of each block seen most often, so a block garbled in one
+transfer is outvoted by the next and the download stops as soon as the
+checksum agrees, usually part way through the second transfer.  Where the
+versions of a block tie the checksum picks between them, when only one
+choice agrees.  A transfer that can be seen to be corrupt as it arrives
+( DumpValidator ) is given up on early and a line that goes quiet for STALL
+seconds ends a transfer instead of hanging the program.  Reads are sized to
+the measured throughput.
 """
 
+import os
+import sys
 import time
 import argparse
-import logging
+from itertools import islice, product
+from collections import Counter, namedtuple
 from prodata import *
+from proserial import PORT, BAUD, open_port
+
+asyncio = lazy_import('asyncio')
+logging = lazy_import('logging')
 
 VERSION = "1.25c"
-PORT = "/dev/ttyUSB0"
-BAUD = 9600
 TICK_CHAR = '.'
-
-
-def parse_commandline():
-    global args, parser
-
-    parser = argparse.ArgumentParser(prog='probate', description=f'Download AltAcc flight data to a file (v{VERSION})')
-    parser.add_argument('-p', '--port', help='serial/com port')
+RETRIES = 4                 # more transfers asked for when one is bad
+BLOCK = 256                 # bytes of the dump counted as one block
+FIRST_BYTE = 3.0            # seconds for the AltAcc to start sending
+STALL = 1.0                 # seconds of quiet that end a transfer
+MIN_CHUNK = 16              # bytes read at a time, at least
+MAX_CHUNK = 1024            # and at most
+READ_TIME = 0.1             # seconds of data wanted for each read
+TIES = 4                    # most ways to settle tied blocks tried, more and a wrong way agrees too often
+
+Download = namedtuple('Download', 'port filename data check seconds error transfers rate')
+
+
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='proread', description=f'Download AltAcc flight data to a file (v{VERSION})')
+    parser.add_argument('-p', '--port', action='append',
+                        help='serial/com port, repeat or comma separate to download several units at once')
     parser.add_argument('-n', '--nit', default=NIT_NAME, help='override init filename')
     parser.add_argument('-o', '--out', help='output flight data filename')
+    parser.add_argument('-r', '--retries', type=int, default=RETRIES,
+                        help=f'more transfers to ask for when one is bad (default {RETRIES})')
 
     parser.add_argument('-q', '--quiet', action='store_true', help="be quiet about it")
     parser.add_argument('--version', action='version', version=f'v{VERSION}')
     parser.add_argument('datafile', default=None, nargs='?', action='store',
-                        help='output flight data filename (same as --out)')
+                        help='output flight data filename (same as --out).  With several ports {unit} '
+                             'is replaced by the port name, otherwise the port name is added to the name')
 
-    args = parser.parse_args()
+    return parser, parser.parse_args(argv)
 
 
-def set_port(port):
-    if port == 'MOCK':
-        class SerMock:
-            name = port
+def unit_name(port):
+    """ a file name friendly name for a port, /dev/ttyUSB0 -> ttyUSB0.  The
+    options of a simulated port ( sim:FILE?errors=... ) are left out
+    """
 
-            def write(self, data):
-                pass
+    port = port.partition('?')[0]
+    return os.path.basename(port.rstrip('/')).replace(':', '') or 'unit'
 
-            def read(self, _):
-                return b'125 236\n'
 
-        return SerMock()
-    else:
-        import serial
-        com = serial.Serial(port=port, baudrate=BAUD)
-        if not com:
-            print(f"could not open {port}")
-            sys.exit(1)
+def unit_filename(filename, port, several):
+    if not filename or not several:
+        return filename
+    if '{unit}' in filename:
+        return filename.replace('{unit}', unit_name(port))
 
-        return com
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}-{unit_name(port)}{ext or '.dat'}"
 
 
-def main():
+class Progress:
+    """ one status line showing every download at once """
+
+    def __init__(self, ports, total, quiet=False):
+        self.total = total
+        self.quiet = quiet
+        self.counts = {port: 0 for port in ports}
+        self.notes = {}
+        self.tries = {}
+
+    def update(self, port, count, note=None):
+        self.counts[port] = count
+        if note:
+            self.notes[port] = note
+        if not self.quiet:
+            print('\r' + '  '.join(self.status(port) for port in self.counts), end='', flush=True)
+
+    def retry(self, port, transfer):
+        self.tries[port] = transfer
+        self.update(port, 0)
+
+    def status(self, port):
+        note = self.notes.get(port)
+        tries = f" try {self.tries[port]}" if port in self.tries else ''
+        return f"{unit_name(port)} {note or '%5d/%d%s' % (self.counts[port], self.total, tries)}"
+
+
+class DumpBlocks:
+    """ a dump put together from as many transfers as it takes """
+
+    def __init__(self, size=altacc_format.size):
+        self.size = size
+        self.count = -(-size // BLOCK)
+        self.versions = [Counter() for _ in range(self.count)]
+        self.latest = [None] * self.count
+        self.transfer = bytearray()
+        self.transfers = 0
+
+    @property
+    def received(self):
+        """ bytes of the current transfer """
+
+        return len(self.transfer)
+
+    def start(self):
+        self.transfer.clear()
+        self.transfers += 1
+
+    def add(self, chunk):
+        """ bytes of the current transfer, True once the dump checks out """
+
+        first = len(self.transfer) // BLOCK
+        self.transfer += chunk
+        last = len(self.transfer) // BLOCK if len(self.transfer) < self.size else self.count
+
+        for b in range(first, last):
+            block = bytes(self.transfer[b * BLOCK:(b + 1) * BLOCK])
+            self.versions[b][block] += 1
+            self.latest[b] = block
+
+        return last > first and self.good()
+
+    def dump(self):
+        """ the most common version of each block up to the first block that
+        never arrived.  Where versions tie the only ones that make the
+        checksum agree are taken, or else the latest
+        """
+
+        tied = []
+        for versions, latest in zip(self.versions, self.latest):
+            if not versions:
+                break
+            top = max(versions.values())
+            tied.append(sorted((block for block, n in versions.items() if n == top), key=lambda b: b != latest))
+
+        # settling ties before every block has come twice would let a bad
+        # block that has come once be made up for by a bad choice elsewhere
+        blocks = [versions[0] for versions in tied]
+        if len(tied) == self.count and all(sum(versions.values()) > 1 for versions in self.versions):
+            blocks = _settle(tied) or blocks
+
+        return b''.join(blocks)
+
+    def good(self):
+        try:
+            DumpValidator().update(self.dump()).finish()
+        except ValueError:
+            return False
+        return True
+
+
+def _settle(tied):
+    """ one version of each block, from lists of the tied versions, that makes
+    the checksum of the dump agree.  None unless exactly one way does, a bit
+    flipped one way in one block and back in another adds up the same, or
+    there are more than TIES ways to try
+    """
+
+    # every block adds to the sum of the bytes before CkSum and to the CkSum
+    # the AltAcc sent, only the blocks with a choice need working out
+    def share(start, block):
+        cksum = sum(block[i - start] << 8 * (i - CKSUM_OFFSET) for i in (CKSUM_OFFSET, CKSUM_OFFSET + 1)
+                    if start <= i < start + len(block))
+        return sum(block[:max(CKSUM_OFFSET - start, 0)]) - cksum
+
+    choices = [(b, [share(b * BLOCK, block) for block in versions]) for b, versions in enumerate(tied)
+               if len(versions) > 1]
+    ways = list(islice(product(*(range(len(shares)) for b, shares in choices)), TIES + 1))
+    if not choices or len(ways) > TIES:
+        return None
+
+    fixed = sum(share(b * BLOCK, versions[0]) for b, versions in enumerate(tied) if len(versions) == 1)
+    agree = [picks for picks in ways
+             if (fixed + sum(shares[i] for (b, shares), i in zip(choices, picks))) % 0x10000 == 0]
+    if len(agree) != 1:
+        return None
+
+    blocks = [versions[0] for versions in tied]
+    for (b, shares), i in zip(choices, agree[0]):
+        blocks[b] = tied[b][i]
+    return blocks
+
+
+async def transfer(com, blocks, port, progress, baud=BAUD):
+    """ ask for one transfer and read it into blocks, True if the dump is
+    good, False if the transfer ends without one or the line goes quiet
+    """
 
-    parse_commandline()
-    print()
-    print(args)
+    # discard any noise on the line
+    com.reset_input_buffer()
+    com.reset_output_buffer()
 
-    # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
-    if not args.quiet:
-        print("reading", args.nit)
-    nit = read_nitfile(args.nit)
+    blocks.start()
+    await com.write(b'/R')
+
+    # check the transfer as it arrives so a corrupt one is given up on early
+    check = DumpValidator()
+
+    byte_time = 10 / baud if baud else 0.0
+    chunk_size = MIN_CHUNK
+    wait = FIRST_BYTE
+    start = first = None
+    while blocks.received < blocks.size:
+        count = min(blocks.size - blocks.received, chunk_size)
+        try:
+            chunk = await com.readexactly(count, wait + count * byte_time)
+        except asyncio.IncompleteReadError as e:
+            blocks.add(e.partial)
+            progress.update(port, blocks.received)
+            return False
+
+        try:
+            check.update(chunk)
+        except ValueError as e:
+            # the blocks from other transfers may still make a good dump
+            logging.info(f"{port}: transfer {blocks.transfers} abandoned at {blocks.received + len(chunk)} bytes, {e}")
+            good = blocks.add(chunk)
+            progress.update(port, blocks.received)
+            return good
+
+        if blocks.add(chunk):
+            progress.update(port, blocks.received)
+            return True
+        progress.update(port, blocks.received)
+
+        # read about READ_TIME seconds of data at a time at the rate it comes
+        now = time.perf_counter()
+        if start is None:
+            start, first = now, blocks.received
+        elif now > start:
+            rate = (blocks.received - first) / (now - start)
+            chunk_size = min(max(int(rate * READ_TIME), MIN_CHUNK), MAX_CHUNK)
+        wait = STALL
+
+    return False
+
+
+async def download(port, filename, progress, baud=BAUD, retries=RETRIES):
+    """ download the flight data from the AltAcc on port, asking for it
+    again up to retries more times until the checksum agrees
+    """
+
+    start = time.perf_counter()
 
-    data_filename = args.datafile or args.out
-    data_len = altacc_format.size
+    try:
+        com = await open_port(port, baud)
+    except OSError as e:
+        progress.update(port, 0, 'failed')
+        return Download._make((port, filename, None, None, 0.0, str(e), 0, 0.0))
 
-    # Open the com port
-    port = args.port or nit['port'] or PORT
-    com = set_port(port)
+    blocks = DumpBlocks()
+    total = 0
+    try:
+        while blocks.transfers <= retries:
+            if blocks.transfers:
+                progress.retry(port, blocks.transfers + 1)
+            good = await transfer(com, blocks, port, progress, baud)
+            total += blocks.received
+            if good:
+                break
+    finally:
+        com.close()
+
+    seconds = time.perf_counter() - start
+    rate = total / seconds if seconds else 0.0
+
+    # a bad dump is kept, with a warning, unless it cannot be an AltAcc dump at all
+    data = blocks.dump()
+    check = DumpValidator()
+    try:
+        check.update(data)
+    except ValueError as e:
+        progress.update(port, len(data), 'abandoned')
+        return Download._make((port, filename, None, check, seconds, f"{e} after {blocks.transfers} transfers",
+                               blocks.transfers, rate))
 
-    if not args.quiet:
-        print(f"downloading flight data from the AltAcc on {port}")
+    return Download._make((port, filename, data, check, seconds, None, blocks.transfers, rate))
 
-    # discard any noise on the line
-    com.reset_input_buffer()
-    com.reset_output_buffer()
 
-    com.write(b'/R')
+async def download_all(ports, filenames, quiet=False, retries=RETRIES):
+    progress = Progress(ports, altacc_format.size, quiet)
+    return await asyncio.gather(*(download(port, name, progress, retries=retries)
+                                  for port, name in zip(ports, filenames)))
 
-    chunk_size = 64
-    bytes_read = 0
-    chunks = []
-    while bytes_read < data_len:
-        chunk = com.read(min(data_len - bytes_read, chunk_size))
-        chunks.append(chunk)
-        bytes_read += len(chunk)
 
-        if not args.quiet:
-            print("\r%5d of %d bytes" % (bytes_read, data_len), end='')
+def save(result, several=False, quiet=False):
+    """ report on a download and write it out, True if it all went well """
 
-    data = b''.join(chunks)
+    data, check = result.data, result.check
 
-    if not args.quiet:
-        print()
+    if several and not quiet:
+        print(f"{result.port}:")
 
-    fields = altacc_format.unpack(data)
-    flight = AltAccDump._make(fields)
+    if result.error:
+        print(f"*** Error ***  {result.port}: {result.error} !")
+        return False
 
-    checksum = sum(data[:-4]) % 0x10000
+    if not quiet:
+        print(f"read {len(data)} bytes in {result.seconds:.2f} sec ( {result.rate:.0f} bytes/sec, "
+              f"{result.transfers} transfer{'s' if result.transfers > 1 else ''} )")
 
-    if not args.quiet:
-        print("AltAcc  CheckSum: %u = %02x %02x" % (flight.CkSum, data[-4], data[-3]))
-        print("Proread CheckSum: %u = %02x %02x" % (checksum, checksum & 0x00ff, (checksum & 0xff00) >> 8))
+    if not quiet and check.complete:
+        print("AltAcc  CheckSum: %u = %02x %02x" % (check.cksum, data[-4], data[-3]))
+        print("Proread CheckSum: %u = %02x %02x" % (check.checksum, check.checksum & 0x00ff,
+                                                   (check.checksum & 0xff00) >> 8))
 
-    if len(data) != data_len:
+    good = True
+    if not check.complete:
         print("*** Warning ***  File Size error reading AltAcc !")
-    if flight.CkSum != checksum:
+        good = False
+    if check.cksum != check.checksum:
         print("*** Warning ***  Check Sum error reading AltAcc !")
+        good = False
 
     try:
-        with open(data_filename, "wb") as fp:
+        with open(result.filename, "wb") as fp:
             fp.write(data)
-        if not args.quiet:
-            print(f"wrote {len(data)} bytes to {data_filename}")
+        if not quiet:
+            print(f"wrote {len(data)} bytes to {result.filename}")
     except TypeError:
         print("*** Warning ***  Bad filename specified.  Data not saved !")
+        good = False
     except IOError:
         print("*** Warning ***  IO error.  Data not saved !")
+        good = False
+
+    return good
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+    print()
+    print(args)
+
+    # go read the .nit file -- (v2) -- Moved here so CalFile, et al are set
+    if not args.quiet:
+        print("reading", args.nit)
+    nit = read_nitfile(args.nit)
+
+    data_filename = args.datafile or args.out
+
+    # Open the com ports
+    ports = [p for spec in args.port or [nit['port'] or PORT] for p in spec.split(',') if p]
+    filenames = [unit_filename(data_filename, port, len(ports) > 1) for port in ports]
+    for name in set(filenames):
+        if name and filenames.count(name) > 1:
+            same = [port for port, filename in zip(ports, filenames) if filename == name]
+            parser.error(f"ports {', '.join(same)} would all write {name}")
+
+    if not args.quiet:
+        print(f"downloading flight data from the AltAcc on {', '.join(ports)}")
+
+    start = time.perf_counter()
+    results = asyncio.run(download_all(ports, filenames, args.quiet, args.retries))
+    elapsed = time.perf_counter() - start
+
+    if not args.quiet:
+        print()
+
+    good = [save(result, len(ports) > 1, args.quiet) for result in results]
+
+    if len(ports) > 1:
+        print()
+        print("%-16s  %-24s  %5s  %-8s  %7s  %5s  %7s" %
+              ("Port", "File", "Bytes", "CheckSum", "Seconds", "Tries", "Bytes/s"))
+        for result, ok in zip(results, good):
+            count = result.check.received if result.check else 0
+            status = 'ok' if ok else 'error' if result.error else 'bad'
+            print("%-16s  %-24s  %5d  %-8s  %7.2f  %5d  %7.0f" %
+                  (result.port, result.filename, count, status, result.seconds, result.transfers, result.rate))
+        print(f"downloaded {good.count(True)} of {len(ports)} units in {elapsed:.2f} sec")
+
+    return 0 if all(good) else 1
 
 
-main()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,598 @@
+"""
+These are the flight reduction routines for the BSR AltAcc software
+
+The reduction works on whole traces rather than one sample at a time.  The
+velocity, altitude, acceleration and gsum traces are numpy running sums and
+differences of the raw channels and the events and peaks are found with
+argmax and flatnonzero, so there is no Python loop over the samples.  The
+results are the same, digit for digit, as the original sample loop in
+produce ( see probench.legacy_reduce ).  The one exception is gsum for a
+onegee that is not a multiple of 1/4 count, the loop subtracts it from the
+running sum and here it comes off each sample first so the last digit can
+differ.  The default onegee, the Window average, always is.
+
+The traces are numpy arrays ( see FlightTrace ), a byte a sample for the raw
+counts and a double for everything worked out from them.
+
+The pressure channel is an 8 bit count so the pressure altitudes come from
+tables of all 256 counts, built once per base pressure and calibration.
+"""
+
+from math import log, exp
+from collections import namedtuple
+from functools import lru_cache, cached_property
+import numpy as np
+import prodata
+
+LAUNCH_THOLD = 16.0      # about 1/4 sec of 1.33 G
+DROGUE_TO_MAIN = 1
+DEFAULT_GAIN = prodata.DEFAULT_GAIN
+GEE = 32.17              # ft/sec^2
+dT = 0.0625              # AltAcc dt 1/16sec
+GROUND_TIME = 5.0        # seconds of data kept after returning to the ground
+
+FlightEvents = namedtuple('FlightEvents', 'mode main_time drogue_time apogee_time apogee_pre')
+FlightSummary = namedtuple('FlightSummary', ' '.join((
+    'atime end_of_time',
+    'maxialt tmaxialt maxvel tmaxvel minacc tminacc maxacc tmaxacc',
+    'minpre tminpre maxpre tmaxpre',
+    'alt_0 agl_alt msl_alt main_alt drogue_alt maxpalt biba_alt',
+)))
+Reduction = namedtuple('Reduction', 'events trace summary')
+EventTable = namedtuple('EventTable', ' '.join((
+    'version mode main_time drogue_time apogee_time',
+    'base_pre drogue_pre main_pre apogee_pre',
+    'main_alt drogue_alt agl_alt',
+)))
+PRESSURE_FIELDS = FlightSummary._fields[-7:]
+
+
+class FlightTrace:
+    """ the sample by sample traces of a flight kept as numpy arrays, the
+    sample times as whole dT ticks, the raw accelerometer and pressure counts
+    a byte a sample and the rest doubles.  It unpacks and _make()s like the
+    namedtuple it replaced, with tee the times in seconds
+    """
+
+    __slots__ = ('ticks', 'gee', 'pre', 'vee', 'acc', 'ialt', 'palt', 'gsum')
+    _fields = ('tee',) + __slots__[1:]
+    dtypes = (np.int16, np.uint8, np.uint8, np.float64, np.float64, np.float64, np.float64, np.float64)
+
+    def __init__(self, ticks, gee, pre, vee, acc, ialt, palt, gsum):
+        for name, dtype, column in zip(self.__slots__, self.dtypes, (ticks, gee, pre, vee, acc, ialt, palt, gsum)):
+            setattr(self, name, np.asarray(column, dtype))
+
+    @property
+    def tee(self):
+        return self.ticks * dT
+
+    @classmethod
+    def _make(cls, iterable):
+        return cls(*iterable)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __eq__(self, other):
+        return isinstance(other, FlightTrace) and all(map(np.array_equal, self, other))
+
+    def __repr__(self):
+        return f"FlightTrace({len(self.ticks)} samples)"
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.__slots__)
+
+
+def simpson(ptr, data, dt):
+    return (data[ptr - 1] + 4 * data[ptr] + data[ptr + 1]) * dt / 3
+
+
+def taylor(ptr, data, dt):
+    # dt is actually dt * 12 here !!!
+    return (data[ptr - 2] - 8 * data[ptr - 1] + 8 * data[ptr + 1] - data[ptr + 2]) / dt
+
+
+# the whole trace kernels, selectable by name.  An integrator returns the
+# running integral of a trace from a zero sample just before the first and a
+# differentiator the derivative at every sample, zero where its stencil does
+# not fit.  dt is the sample interval times any scale factor
+INTEGRATORS = {}
+DIFFERENTIATORS = {}
+Kernels = namedtuple('Kernels', 'velocity altitude derivative')
+KERNELS = Kernels('trapezoid', 'altacc', 'taylor')
+
+
+def kernel(registry, name):
+    """ decorator adding a kernel to INTEGRATORS or DIFFERENTIATORS """
+
+    def register(func):
+        registry[name] = func
+        return func
+
+    return register
+
+
+def parse_kernels(text):
+    """ Kernels from 'velocity,altitude,derivative' names, blanks are the default """
+
+    names = (text.split(',') + [''] * 3)[:3] if text else [''] * 3
+    kernels = Kernels._make(name or default for name, default in zip(names, KERNELS))
+    for name, registry in zip(kernels, (INTEGRATORS, INTEGRATORS, DIFFERENTIATORS)):
+        if name not in registry:
+            raise ValueError(f"unknown kernel {name}, pick from {', '.join(registry)}")
+
+    return kernels
+
+
+@kernel(INTEGRATORS, 'trapezoid')
+def integrate_trapezoid(values, dt):
+    """I tried Simpson's rule but the noise in the accelerometer output made
+    the output less accurate than a simple trapezoid integral.  This also
+    made the 3-element array for Altitude ( s[] ) moot but it is easier
+    """
+
+    steps = (np.concatenate(([0.0], values))[:-1] + values) * (dt / 2)
+    return np.cumsum(np.concatenate(([0.0], steps)))[1:]
+
+
+@kernel(INTEGRATORS, 'altacc')
+def integrate_altacc(values, dt):
+    """ the original AltAcc altitude integral, not quite Simpson's rule.  Each
+    step is the Simpson area over the 2dT around a sample less the step
+    before, so it runs from the first sample ( which is zero ) rather than
+    from a sample before it.  The step at the last sample is never used and
+    the sample after it is taken as zero.  Flipping the sign of every other
+    area turns the recurrence into a running sum
+    """
+
+    v = np.append(values, 0.0)
+    areas = (v[:-2] + 4 * v[1:-1] + v[2:]) * dt / 3
+    sign = np.ones(len(areas))
+    sign[1::2] = -1.0
+    steps = np.cumsum(areas * sign) * sign
+    return np.cumsum(np.concatenate(([0.0], steps)))[:len(values)]
+
+
+@kernel(INTEGRATORS, 'simpson')
+def integrate_simpson(values, dt):
+    """ composite Simpson's rule.  Each pair of intervals is a parabola
+    through three samples, split into its two halves so the integral is
+    Simpson's at every other sample and the first half of the next parabola
+    in between.  An odd last interval takes the second half of the parabola
+    before it
+    """
+
+    f = np.concatenate(([0.0], values))
+    n = len(values)
+    opening = (5 * f[:-2] + 8 * f[1:-1] - f[2:]) * (dt / 12)
+    closing = (8 * f[1:-1] + 5 * f[2:] - f[:-2]) * (dt / 12)
+
+    steps = np.empty(n)
+    steps[0:n - 1:2] = opening[0::2]
+    steps[1::2] = closing[0::2]
+    if n % 2:
+        steps[-1] = closing[-1] if n > 1 else (f[0] + f[1]) * (dt / 2)
+    return np.cumsum(steps)
+
+
+@kernel(INTEGRATORS, 'cumsum')
+def integrate_cumsum(values, dt):
+    return np.cumsum(values * dt)
+
+
+@kernel(INTEGRATORS, 'savgol')
+def integrate_savgol(values, dt):
+    """ trapezoid integral of the trace smoothed by a 5 point quadratic
+    Savitzky-Golay filter, the end samples are left as they are
+    """
+
+    v = np.asarray(values, np.float64)
+    smooth = v.copy()
+    smooth[2:-2] = (-3 * v[:-4] + 12 * v[1:-3] + 17 * v[2:-2] + 12 * v[3:-1] - 3 * v[4:]) / 35
+    return integrate_trapezoid(smooth, dt)
+
+
+@kernel(DIFFERENTIATORS, 'taylor')
+def differentiate_taylor(values, dt):
+    """ Taylor's 2nd order 2-step derivative """
+
+    out = np.zeros(len(values))
+    out[2:-2] = (values[:-4] - 8 * values[1:-3] + 8 * values[3:-1] - values[4:]) / (12 * dt)
+    return out
+
+
+@kernel(DIFFERENTIATORS, 'central')
+def differentiate_central(values, dt):
+    out = np.zeros(len(values))
+    out[1:-1] = (values[2:] - values[:-2]) / (2 * dt)
+    return out
+
+
+@kernel(DIFFERENTIATORS, 'savgol')
+def differentiate_savgol(values, dt):
+    """ the 5 point quadratic Savitzky-Golay first derivative """
+
+    out = np.zeros(len(values))
+    out[2:-2] = (-2 * values[:-4] - values[1:-3] + values[3:-1] + 2 * values[4:]) / (10 * dt)
+    return out
+
+
+@kernel(DIFFERENTIATORS, 'difference')
+def differentiate_difference(values, dt):
+    """ backward difference, the inverse of cumsum """
+
+    out = np.zeros(len(values))
+    out[1:] = np.diff(values) / dt
+    return out
+
+
+def pressure_alt(press, press_0, cal):
+    """The Motorola data sheet sez 4.5 V / 14.5 PSI which implies 4.56 V
+    at 14.7 PSI.  The unit output is 209 / 14.7 while the ideal is
+    229.5 at 14.5 ( assume 255 / 5 Unit / volt ).  This means the
+    readings are offset low 23.3 units.  PALT_OFFSET is hardcoded
+    for now to +23.3 and all readings are adjusted up by this value.
+    """
+
+    if press <= 0:
+        return None
+
+    p0 = press_0 * cal['GainBP'] + cal['OffBP']
+    p1 = press * cal['GainBP'] + cal['OffBP']
+    ln_dp = log(p1 / p0)
+
+    alt = (1 - exp(ln_dp / 5.2556)) / 0.00000688
+
+    return alt
+
+
+@lru_cache(maxsize=prodata.PALT_TABLES)
+def _pressure_alt_table(press_0, gain, offset):
+    cal = {'GainBP': gain, 'OffBP': offset}
+    table = []
+    for press in range(256):
+        try:
+            table.append(pressure_alt(press, press_0, cal))
+        except (ValueError, ZeroDivisionError):
+            table.append(None)      # no altitude for a count below the transducer offset
+    return tuple(table)
+
+
+@lru_cache(maxsize=prodata.PALT_TABLES)
+def _palt3_array(press_0):
+    """ prodata.palt3_table as an array for indexing with a whole pressure
+    trace, 0.0 where there is no altitude
+    """
+
+    return np.array([alt or 0.0 for alt in prodata.palt3_table(press_0)])
+
+
+def pressure_alt_table(press_0, cal):
+    """ pressure_alt for every pressure count 0 - 255 against press_0, cached
+    per base pressure and calibration like prodata.palt3_table
+    """
+
+    return _pressure_alt_table(press_0, cal['GainBP'], cal['OffBP'])
+
+
+def _altitude(table, press):
+    """ a pressure_alt_table lookup that raises ValueError, as pressure_alt
+    would have, for a count the calibration puts at or below zero pressure
+    """
+
+    alt = table[press]
+    if alt is None and press > 0:
+        raise ValueError(f"no pressure altitude for count {press}, the calibration puts it at or below zero pressure")
+    return alt
+
+
+def convert_time(sec, sec_16):
+    return sec + (sec_16 & 0xE0) * 8.0 + (sec_16 & 0x0F) / 16.0
+
+
+def flight_events(flight):
+    """ gather event data from the flight data header """
+
+    flight_mode = flight.BSFlags & 0x01
+
+    main_time = convert_time(flight.MainSec, flight.Main16s)
+    if flight_mode == DROGUE_TO_MAIN:
+        drogue_time = convert_time(flight.DrogueSec, flight.Drogue16s)
+        return FlightEvents._make((flight_mode, main_time, drogue_time, drogue_time, flight.DroguePre))
+
+    return FlightEvents._make((flight_mode, main_time, None, main_time, flight.MainPre))
+
+
+def _clock(ticks, events):
+    """ fill ticks with the sample times of the flight data in dT ticks.  Each
+    pyro firing costs the AltAcc 0.25 sec so the tick after a firing jumps by
+    4 instead of 1
+    """
+
+    fire = {int(t / dT) for t in (events.main_time, events.drogue_time)
+            if t is not None and (t / dT).is_integer()}
+
+    # the steps from one tick to the next, then their running sum
+    ticks[:] = 1
+    pos, cur = 0, 4
+    for f in sorted(fire):
+        if f >= cur:
+            pos += f - cur
+            if pos < len(ticks):
+                ticks[pos] = 4
+            pos, cur = pos + 1, f + 4
+
+    np.cumsum(ticks, out=ticks)
+    ticks += 4
+
+
+def _peak(values, times, init, lowest=False):
+    """ (value, time) of the first highest ( or lowest ) sample if it is
+    beyond init, else init
+    """
+
+    if not len(values):
+        return init
+    i = np.argmin(values) if lowest else np.argmax(values)
+    if values[i] < init[0] if lowest else values[i] > init[0]:
+        return values[i].item(), times[i].item()
+    return init
+
+
+def _first(mask, start=0):
+    """ index of the first True in mask from start on or None """
+
+    hits = np.flatnonzero(mask[start:])
+    return start + int(hits[0]) if len(hits) else None
+
+
+def pressure_summary(flight, cal, apogee_pre, minpre):
+    """ the summary altitudes, the only part of a reduction that depends on
+    the pressure calibration ( OffBP and GainBP ).  A tuple of the
+    PRESSURE_FIELDS of the FlightSummary
+    """
+
+    # v1.25 compute pressure for ideal sea level 29.921 inHg TODO: cal is in kPa!
+    palt_0 = (29.921 - cal['OffBP']) / cal['GainBP']
+    sea_level = pressure_alt_table(palt_0, cal)
+    site = pressure_alt_table(flight.BasePre, cal)
+
+    # launch site alt
+    alt_0 = _altitude(sea_level, flight.BasePre)
+
+    agl_alt = _altitude(site, apogee_pre)
+    msl_alt = _altitude(sea_level, apogee_pre) - alt_0
+    main_alt = _altitude(site, flight.MainPre)
+    drogue_alt = _altitude(site, flight.DroguePre)
+    maxpalt = _altitude(site, minpre)
+    biba_alt = prodata.palt3_table(flight.BasePre)[apogee_pre]
+
+    return alt_0, agl_alt, msl_alt, main_alt, drogue_alt, maxpalt, biba_alt
+
+
+def event_table(flight, cal=None):
+    """ the events of a flight from its header alone, the Data is not needed
+    so prodata.read_header will do.  The altitudes above the launch site are
+    only worked out given a calibration and are None where there is none
+    """
+
+    events = flight_events(flight)
+    alts = (None, None, None)
+    if cal is not None:
+        site = pressure_alt_table(flight.BasePre, cal)
+        alts = (site[flight.MainPre], site[flight.DroguePre] if events.drogue_time is not None else None,
+                site[events.apogee_pre])
+
+    return EventTable._make((flight.Version, events.mode, events.main_time, events.drogue_time, events.apogee_time,
+                             flight.BasePre, flight.DroguePre, flight.MainPre, events.apogee_pre) + alts)
+
+
+class FlightPipeline:
+    """ a flight reduction as named stages evaluated on first use and kept,
+    so asking for the apogee time never integrates the accelerometer and
+    asking for the summary works out only what the summary needs
+
+        events      flight mode and event times from the header
+        channels    time, accelerometer and pressure samples
+        gsum        running sum of the accelerometer less one gee
+        landing     apogee time, end of the data kept and its index
+        velocity    integral of the accelerometer ( trapezoid )
+        ialt        integral of the velocity ( altacc )
+        acc         derivative of the velocity ( taylor )
+        palt        pressure altitude of every sample
+        peaks       the inertial maxima and minima up to apogee
+        pressures   the pressure extremes
+        altitudes   the pressure altitudes of the events
+        trace, summary, reduction   the results as reduce_flight gives them
+    """
+
+    def __init__(self, flight, cal, slope, onegee, all_data=False, kernels=KERNELS):
+        self.flight = flight
+        self.cal = cal
+        self.slope = slope
+        self.onegee = onegee
+        self.all_data = all_data
+        self.kernels = kernels
+
+    @cached_property
+    def events(self):
+        return flight_events(self.flight)
+
+    @cached_property
+    def channels(self):
+        """ (ticks, gee, pre) up to and including the end of data marker """
+
+        flight = self.flight
+
+        # the flight data is stored as alternating samples A P A P A P ...
+        # and ends with the first 254 on the pressure channel
+        data = np.frombuffer(flight.Data, np.uint8)
+        data_acc, data_pre = data[0::2], data[1::2]
+        marker = np.flatnonzero(data_pre == prodata.END_OF_DATA)
+        if len(marker):
+            samples = marker[0] + 1
+            data_acc, data_pre = data_acc[:samples], data_pre[:samples]
+
+        # 1/4 second before launch then oldest, older, old, cur acceleration
+        n = 8 + len(data_acc)
+        gee = np.empty(n, np.uint8)
+        gee[:4] = [flight.Window[(flight.WinPtr + i + 1) % 4] for i in range(4)]
+        gee[4:8] = list(flight.NitAcc)
+        gee[8:] = data_acc
+        pre = np.empty(n, np.uint8)
+        pre[:8] = flight.BasePre
+        pre[8:] = data_pre
+
+        ticks = np.empty(n, np.int16)
+        ticks[:8] = range(-3, 5)
+        _clock(ticks[8:], self.events)
+
+        return ticks, gee, pre
+
+    @cached_property
+    def _data_end(self):
+        # the reduction stops at the end of data marker
+        pre = self.channels[2]
+        end = _first(pre == prodata.END_OF_DATA)
+        return len(pre) if end is None else end
+
+    @cached_property
+    def gsum(self):
+        goffset = self.onegee               # experimental ...
+        gee, end = self.channels[1], self._data_end
+        gsum = np.zeros(max(end, 4))
+        np.cumsum(gee[4:end] - goffset, out=gsum[4:])
+        return gsum
+
+    @cached_property
+    def landing(self):
+        """ (atime, end_of_time, end) where end is the number of samples kept """
+
+        ticks, gee, pre = self.channels
+        gsum = self.gsum
+        end = self._data_end
+
+        # apogee is when the gsum comes back to zero after launch
+        atime = apogee = None
+        launch = _first(gsum > LAUNCH_THOLD, 4)
+        if launch is not None:
+            apogee = _first(gsum <= 0.0, launch + 1)
+            if apogee is not None:
+                atime = ticks[apogee].item() * dT
+
+        # (v2) -- Break early if we get back to the ground
+        end_of_time = None
+        if atime and not self.all_data:
+            ground = _first(pre[:end] >= self.flight.BasePre, int(np.searchsorted(ticks[:end], ticks[apogee], 'right')))
+            if ground is not None:
+                end_of_time = ticks[ground].item() * dT + GROUND_TIME
+                end = int(np.searchsorted(ticks[:end], ticks[ground] + GROUND_TIME / dT, 'right'))
+
+        return atime, end_of_time, end
+
+    @cached_property
+    def velocity(self):
+        """ the velocity of every sample, not cut off at the end """
+
+        # the pre launch window is at rest
+        gee = self.channels[1]
+        vee = np.zeros(len(gee))
+        vee[4:] = INTEGRATORS[self.kernels.velocity](gee[4:] - self.onegee, dT * GEE / self.slope)
+        return vee
+
+    @cached_property
+    def _padded_velocity(self):
+        # I want to use Simpson's rule for altitude and Taylor's 2nd order
+        # 2-step derivative to back acceleration from velocity.  Pad the end
+        # of the velocity with zeros for Taylor ()
+        end = self.landing[2]
+        vee = self.velocity[:end + 2]
+        v = np.zeros(end + 2)
+        v[:len(vee)] = vee
+        return v
+
+    @cached_property
+    def ialt(self):
+        end, v = self.landing[2], self._padded_velocity
+        # TODO: this seems to come out too low
+        ialt = np.zeros(end)
+        ialt[3:] = INTEGRATORS[self.kernels.altitude](v[3:end + 1], dT)[:-1]
+        return ialt
+
+    @cached_property
+    def acc(self):
+        end, v = self.landing[2], self._padded_velocity
+        acc = np.zeros(end)
+        acc[4:] = DIFFERENTIATORS[self.kernels.derivative](v, dT)[4:end]
+        return acc
+
+    @cached_property
+    def palt(self):
+        end, pre = self.landing[2], self.channels[2]
+        palt = np.zeros(end)
+        palt[4:] = _palt3_array(self.flight.BasePre)[pre[4:end]]
+        return palt
+
+    @cached_property
+    def trace(self):
+        ticks, gee, pre = self.channels
+        end = self.landing[2]
+        return FlightTrace._make((ticks[:end], gee[:end], pre[:end], self.velocity[:end], self.acc, self.ialt,
+                                  self.palt, self.gsum[:end]))
+
+    @cached_property
+    def peaks(self):
+        """ maxialt tmaxialt maxvel tmaxvel minacc tminacc maxacc tmaxacc """
+
+        atime, end_of_time, end = self.landing
+        tee, ialt, vee, acc, gsum = self.channels[0][:end] * dT, self.ialt, self.velocity[:end], self.acc, self.gsum
+
+        # maxima are taken up to apogee and accelerations only under thrust
+        w = _first(tee == atime) + 1 if atime else end
+        maxialt, tmaxialt = _peak(ialt[:w], tee, (0.0, 0.0))
+        maxvel, tmaxvel = _peak(vee[:w], tee, (0.0, 0.0))
+        thrust = gsum[:len(acc[:w])] >= 0.0
+        thrust_acc, thrust_tee = acc[:w][thrust], tee[:len(thrust)][thrust]
+        minacc, tminacc = _peak(thrust_acc, thrust_tee, (0.0, -1.0), lowest=True)
+        maxacc, tmaxacc = _peak(thrust_acc, thrust_tee, (0.0, 0.0))
+
+        return maxialt, tmaxialt, maxvel, tmaxvel, minacc, tminacc, maxacc, tmaxacc
+
+    @cached_property
+    def pressures(self):
+        """ minpre tminpre maxpre tmaxpre """
+
+        end = self.landing[2]
+        tee, pre = self.channels[0][:end] * dT, self.channels[2][:end]
+
+        # the last of the lowest pressures
+        minpre, tminpre = 255, 0.0
+        if len(pre):
+            i = len(pre) - 1 - np.argmin(pre[::-1])
+            minpre, tminpre = pre[i].item(), tee[i].item()
+        maxpre, tmaxpre = _peak(pre, tee, (0, 0.0))
+
+        return minpre, tminpre, maxpre, tmaxpre
+
+    @cached_property
+    def altitudes(self):
+        return pressure_summary(self.flight, self.cal, self.events.apogee_pre, self.pressures[0])
+
+    @cached_property
+    def summary(self):
+        return FlightSummary._make(self.landing[:2] + self.peaks + self.pressures + self.altitudes)
+
+    @cached_property
+    def reduction(self):
+        return Reduction._make((self.events, self.trace, self.summary))
+
+
+def reduce_flight(flight, cal, slope, onegee, all_data=False, kernels=KERNELS):
+    """ reduce a flight dump to its time, velocity, altitude and acceleration
+    traces plus the summary values the reports need.  Unless all_data is set
+    the traces end GROUND_TIME seconds after the rocket is back on the ground.
+    kernels names the velocity, altitude and derivative kernels to use
+    """
+
+    return FlightPipeline(flight, cal, slope, onegee, all_data, kernels).reduction
@@ -0,0 +1,302 @@
+"""
+These are the serial port routines for the BSR AltAcc software
+
+A Port is a buffered, non-blocking connection to one AltAcc.  Whatever the
+backend receives is appended to the port buffer as it arrives and the read
+coroutines wait on the buffer, so one asyncio event loop can drive any number
+of ports without a thread per port.  The backends are
+
+    SerialBackend   a real serial port through pyserial ( imported on use )
+    PtyBackend      a pseudo terminal, e.g. one served by a simulator
+    SimBackend      an in-process device object, no file descriptors at all
+
+open_port() picks the backend from the port name: "pty:/dev/pts/N" for a
+pty, "sim:FILE" for an in-process prosim unit replaying a data file, "MOCK"
+for a prosim unit with nothing recorded and anything else is a serial port.
+Simulator options can follow the file, "sim:FILE?errors=0.001&seed=1".
+"""
+
+import os
+from prodata import lazy_import
+
+asyncio = lazy_import('asyncio')
+logging = lazy_import('logging')
+
+PORT = "/dev/ttyUSB0"
+BAUD = 9600
+READ_SIZE = 1024            # bytes asked of the OS per read
+
+
+class Port:
+    """ buffered non-blocking AltAcc connection """
+
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self._buffer = bytearray()
+        self._waiter = None
+        self._eof = False
+
+        backend.start(self)
+
+    def feed(self, data):
+        """ called by the backend with bytes from the AltAcc """
+
+        self._buffer += data
+        self._wake()
+
+    def feed_eof(self):
+        self._eof = True
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self, ready, timeout):
+        """ wait until ready() is true, the line closes or timeout seconds pass """
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while not ready() and not self._eof:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            self._waiter = loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, remaining)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self._waiter = None
+
+        return ready()
+
+    def _take(self, count):
+        data = bytes(self._buffer[:count])
+        del self._buffer[:count]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    async def read(self, count, timeout=None):
+        """ up to count bytes as soon as there are any, b'' on timeout or eof """
+
+        await self._wait(lambda: self._buffer, timeout)
+        return self._take(count)
+
+    async def readexactly(self, count, timeout=None):
+        """ count bytes or asyncio.IncompleteReadError with what did arrive """
+
+        if not await self._wait(lambda: len(self._buffer) >= count, timeout):
+            raise asyncio.IncompleteReadError(self._take(count), count)
+        return self._take(count)
+
+    async def readuntil(self, separator=b'\n', timeout=None):
+        """ bytes up to and including separator or asyncio.IncompleteReadError """
+
+        if not await self._wait(lambda: separator in self._buffer, timeout):
+            raise asyncio.IncompleteReadError(self._take(len(self._buffer)), None)
+        return self._take(self._buffer.index(separator) + len(separator))
+
+    async def write(self, data):
+        await self.backend.write(data)
+
+    def reset_input_buffer(self):
+        self.backend.reset_input()
+        self._buffer.clear()
+
+    def reset_output_buffer(self):
+        self.backend.reset_output()
+
+    def close(self):
+        self.backend.close()
+        self.feed_eof()
+
+
+class FdBackend:
+    """ a tty file descriptor watched by the event loop """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.port = None
+        self.loop = None
+
+    def start(self, port):
+        self.port = port
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.fd, self._ready)
+
+    def _ready(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if data:
+            self.port.feed(data)
+        else:
+            self.loop.remove_reader(self.fd)
+            self.port.feed_eof()
+
+    async def write(self, data):
+        loop = self.loop
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                ready = loop.create_future()
+                loop.add_writer(self.fd, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(self.fd)
+
+    def reset_input(self):
+        import termios
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def reset_output(self):
+        import termios
+        termios.tcflush(self.fd, termios.TCOFLUSH)
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+class PtyBackend(FdBackend):
+    """ a pseudo terminal in raw mode at the given baud rate """
+
+    def __init__(self, path, baud=BAUD):
+        import tty
+        import termios
+
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(fd)
+        attr = termios.tcgetattr(fd)
+        speed = getattr(termios, f"B{baud}", termios.B9600)
+        attr[4] = attr[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attr)
+
+        super().__init__(fd)
+
+
+class SerialBackend(FdBackend):
+    """ a real serial port.  On posix the pyserial file descriptor is watched
+    like a pty, elsewhere the port is polled from the event loop
+    """
+
+    POLL = 0.01     # seconds between polls where there is no fd to watch
+
+    def __init__(self, path, baud=BAUD):
+        import serial
+
+        self.serial = serial.Serial(port=path, baudrate=baud, timeout=0, write_timeout=0)
+        self._poller = None
+        super().__init__(self.serial.fileno() if os.name == 'posix' else None)
+
+    def start(self, port):
+        if self.fd is not None:
+            return super().start(port)
+
+        self.port = port
+        self.loop = asyncio.get_running_loop()
+        self._poller = self.loop.create_task(self._poll())
+
+    async def _poll(self):
+        while self.serial.is_open:
+            data = self.serial.read(self.serial.in_waiting or 1)
+            if data:
+                self.port.feed(data)
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(self.POLL)
+
+    async def write(self, data):
+        if self.fd is not None:
+            return await super().write(data)
+
+        self.serial.write(data)
+        while self.serial.out_waiting:
+            await asyncio.sleep(self.POLL)
+
+    def reset_input(self):
+        self.serial.reset_input_buffer()
+
+    def reset_output(self):
+        self.serial.reset_output_buffer()
+
+    def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        elif self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        self.fd = None
+        self.serial.close()
+
+
+class SimBackend:
+    """ an in-process device.  The device gets what the host writes through
+    receive() and answers by calling the send function it was connected to
+    """
+
+    def __init__(self, device):
+        self.device = device
+
+    def start(self, port):
+        self.device.connect(port.feed)
+
+    async def write(self, data):
+        self.device.receive(data)
+
+    def reset_input(self):
+        pass
+
+    def reset_output(self):
+        pass
+
+    def close(self):
+        self.device.connect(None)
+
+
+async def open_port(port, baud=BAUD):
+    """ open an AltAcc port by name, raises OSError if it cannot be opened """
+
+    if port == 'MOCK' or port.startswith('sim:'):
+        import prosim
+        from urllib.parse import parse_qsl
+
+        path, _, query = port[4:].partition('?')
+        try:
+            options = {k: int(v) if k == 'seed' else float(v) for k, v in parse_qsl(query, strict_parsing=bool(query))}
+            if path:
+                device = prosim.AltAccSim.from_file(path, baud=baud, **options)
+            else:
+                device = prosim.AltAccSim(baud=baud, **options)
+        except (OSError, ValueError, TypeError) as e:
+            raise OSError(f"could not open {port}: {e}")
+        backend = SimBackend(device)
+    elif port.startswith('pty:'):
+        backend = PtyBackend(port[4:], baud)
+    else:
+        try:
+            backend = SerialBackend(port, baud)
+        except ImportError:
+            raise OSError(f"pyserial is needed to open {port}")
+        except Exception as e:      # serial.SerialException
+            raise OSError(f"could not open {port}: {e}")
+
+    logging.info(f"opened AltAcc port {port} at {baud} baud")
+
+    return Port(port, backend)
+
@@ -0,0 +1,288 @@
+""" prosim
+
+This program simulates BSR AltAcc units for testing and load testing the
+download, calibration and clear programs without the hardware.
+
+Each simulated unit speaks the AltAcc serial protocol
+
+    /R      dump the 8196 byte flight data memory
+    /T      test mode, stream "acc pre" sample lines until the next command
+    /CC     clear the flight data memory, "OK" when the erase is done ( an
+            assumed reply, see proclear )
+
+at a configurable baud rate ( 10 bits a byte ).  A unit replays a real data
+file like sample.dat and in test mode its samples follow the calibration
+sequence probate walks through ( right side up for the pressure, then upside
+down, flat and right side up again ) with a little sensor noise and the odd
+\\x00 from the LED sharing the serial line.  The units are served on pseudo
+terminals, any number at once on one event loop, or used in-process through
+proserial ( port "sim:FILE" ).
+"""
+
+import os
+import sys
+import random
+import asyncio
+import argparse
+import prodata
+
+logging = prodata.lazy_import('logging')
+
+VERSION = "1.25c"
+BAUD = 9600
+CLEAR_TIME = 55             # seconds the EEProm erase takes
+CLEAR_REPLY = b'OK'         # what the simulator sends when the erase is done
+TEST_GEES = (1, -1, 0, 1)   # orientation for each /T request, in probate order
+SLOPE = 3.9                 # simulated accelerometer GHarrys per G
+CHUNK = 16                  # bytes written at a time when pacing the line
+
+
+def bench_dump(acc=125, pre=236):
+    """ the memory of a unit sitting on the bench with no flight recorded """
+
+    header = prodata.header_format.pack(0xfe, 0, 0, 0, 0, 0, 0, 0, 0, 0, pre, pre, 0, bytes([acc] * 4), acc,
+                                        bytes([acc] * 4), 0, 0)
+    return seal(header + bytes([prodata.END_OF_DATA]) * prodata.DATA_SIZE)
+
+
+def seal(memory):
+    """ add the checksum and 'OK' to the first 8192 bytes of a dump """
+
+    memory = bytes(memory[:prodata.CKSUM_OFFSET])
+    return memory + prodata.trailer_format.pack(sum(memory) % 0x10000, b'OK')
+
+
+class AltAccSim:
+    """ one simulated AltAcc.  The host side calls receive() with what it
+    writes and the unit answers through the send function given to
+    connect(), which may be a plain function or a coroutine function
+    """
+
+    def __init__(self, data=None, baud=BAUD, noise=0.0, errors=0.0, clear_time=CLEAR_TIME, slope=SLOPE,
+                 seed=None):
+        if data and len(data) < prodata.CKSUM_OFFSET:
+            raise ValueError(f"{len(data)} bytes is too short for an AltAcc dump")
+
+        # a whole dump is replayed as it is, bad checksum and all, only a bare
+        # memory image is given a trailer
+        if not data:
+            self.memory = bench_dump()
+        elif len(data) < prodata.altacc_format.size:
+            self.memory = seal(data)
+        else:
+            self.memory = bytes(data[:prodata.altacc_format.size])
+        self.baud = baud
+        self.noise = noise              # chance of an LED \x00 in a /T line
+        self.errors = errors            # chance of a corrupt byte in a /R dump
+        self.clear_time = clear_time
+        self.slope = slope
+        self.random = random.Random(seed)
+
+        self.send = None
+        self.tests = 0
+        self._pending = b''
+        self._task = None
+        self._busy = False
+
+        flight = prodata.AltAccDump._make(prodata.altacc_format.unpack(self.memory))
+        self.onegee = sum(flight.Window) / 4.0
+        self.pressure = flight.BasePre
+
+    @classmethod
+    def from_file(cls, path, **options):
+        with open(path, 'rb') as fp:
+            return cls(fp.read(), **options)
+
+    def connect(self, send):
+        self.send = send
+        if send is None:
+            self.stop()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def receive(self, data):
+        """ bytes from the host, commands start with a / """
+
+        if self._busy:
+            return              # deaf while erasing
+
+        self._pending += data
+        while b'/' in self._pending:
+            self._pending = self._pending[self._pending.index(b'/'):]
+            if len(self._pending) < 2:
+                return
+
+            cmd = self._pending[1:2]
+            if cmd == b'C':
+                if len(self._pending) < 3:
+                    return
+                if self._pending[2:3] == b'C':
+                    self._start(self._clear())
+                self._pending = self._pending[3:]
+            else:
+                if cmd == b'R':
+                    self._start(self._dump())
+                elif cmd == b'T':
+                    self._start(self._test())
+                self._pending = self._pending[2:]
+
+    def _start(self, coro):
+        self.stop()
+        self._task = asyncio.get_running_loop().create_task(coro)
+
+    async def _emit(self, data):
+        """ send data to the host no faster than the baud rate allows """
+
+        for i in range(0, len(data), CHUNK):
+            chunk = data[i:i + CHUNK]
+            result = self.send(chunk) if self.send else None
+            if asyncio.iscoroutine(result):
+                await result
+            await asyncio.sleep(len(chunk) * 10 / self.baud if self.baud else 0)
+
+    async def _dump(self):
+        data = bytearray(self.memory)
+        for i in range(len(data)):
+            if self.errors and self.random.random() < self.errors:
+                data[i] ^= 1 << self.random.randrange(8)
+        await self._emit(bytes(data))
+
+    def sample(self, gees):
+        acc = round(self.onegee + (gees - 1) * self.slope + self.random.gauss(0, 0.3))
+        pre = round(self.pressure + self.random.gauss(0, 0.3))
+        return min(max(acc, 0), 255), min(max(pre, 0), 255)
+
+    async def _test(self):
+        gees = TEST_GEES[self.tests % len(TEST_GEES)]
+        self.tests += 1
+
+        while True:
+            line = b'%3d %3d\n' % self.sample(gees)
+            if self.noise and self.random.random() < self.noise:
+                at = self.random.randrange(len(line) - 1)
+                line = line[:at] + b'\x00' + line[at:]
+            await self._emit(line)
+
+    async def _clear(self):
+        self._busy = True
+        try:
+            await asyncio.sleep(self.clear_time)
+            header = self.memory[:prodata.DATA_OFFSET]
+            self.memory = seal(header + bytes([prodata.END_OF_DATA]) * prodata.DATA_SIZE)
+        finally:
+            self._busy = False
+        await self._emit(CLEAR_REPLY)
+
+
+class PtyUnit:
+    """ serve a simulated unit on a pseudo terminal.  The slave side stays
+    open here so programs can come and go without hanging up the line
+    """
+
+    def __init__(self, sim):
+        # no pseudo terminals on Windows, the in-process sim: ports still work there
+        import pty
+        import tty
+
+        self.sim = sim
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = 'pty:' + os.ttyname(self.slave)
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.master, self._ready)
+        self.sim.connect(self.send)
+
+    def _ready(self):
+        try:
+            data = os.read(self.master, 1024)
+        except (BlockingIOError, OSError):
+            return
+        self.sim.receive(data)
+
+    async def send(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.master, view):]
+            except BlockingIOError:
+                ready = self.loop.create_future()
+                self.loop.add_writer(self.master, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    self.loop.remove_writer(self.master)
+
+    def close(self):
+        self.sim.connect(None)
+        if self.loop is not None:
+            self.loop.remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def start_units(datafiles, count=None, **options):
+    """ start simulated units on ptys ( inside a running loop ), one per data
+    file or count of them cycling through the files.  Returns the PtyUnits
+    """
+
+    count = count or len(datafiles) or 1
+    units = []
+    for i in range(count):
+        path = datafiles[i % len(datafiles)] if datafiles else None
+        sim = AltAccSim.from_file(path, **options) if path else AltAccSim(**options)
+        unit = PtyUnit(sim)
+        unit.start()
+        units.append(unit)
+
+    return units
+
+
+def parse_commandline(argv=None):
+    parser = argparse.ArgumentParser(prog='prosim', description=f'AltAcc unit simulator (v{VERSION})')
+    parser.add_argument('-u', '--units', type=int, help='number of units (default one per data file)')
+    parser.add_argument('-b', '--baud', type=int, default=BAUD, help='line speed, 0 for as fast as possible')
+    parser.add_argument('--noise', type=float, default=0.0, help='chance of LED noise in a /T sample line')
+    parser.add_argument('--errors', type=float, default=0.0, help='chance of a corrupt byte in a /R dump')
+    parser.add_argument('--clear-time', type=float, default=CLEAR_TIME, help='seconds for a /CC erase')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--version', action='version', version=f'v{VERSION}')
+    parser.add_argument('datafiles', nargs='*', help='flight data files for the units to replay')
+
+    return parser, parser.parse_args(argv)
+
+
+async def serve(args):
+    units = start_units(args.datafiles, args.units, baud=args.baud, noise=args.noise, errors=args.errors,
+                        clear_time=args.clear_time, seed=args.seed)
+
+    print(','.join(unit.port for unit in units), flush=True)
+    logging.info(f"serving {len(units)} simulated AltAcc units")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for unit in units:
+            unit.close()
+
+
+def main(argv=None):
+
+    parser, args = parse_commandline(argv)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
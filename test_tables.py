@@ -0,0 +1,52 @@
+""" the pressure altitude tables against the formulas they replace, run with pytest """
+
+import pytest
+import prodata
+import proreduce
+
+CALS = (
+    None,
+    {'GainBP': 0.37037, 'OffBP': 13.6},      # the palt3 defaults
+    {'GainBP': 1.0, 'OffBP': 23.3},          # prodata.cal
+    {'GainBP': 0.45, 'OffBP': 5.0},
+    {'GainBP': 0.5, 'OffBP': -20.0},         # counts below 40 are under zero pressure
+    {'GainBP': 2.0, 'OffBP': 0.0},
+)
+BASE_PRESSURES = (0, 1, 100, 200, 236, 254, 255)
+
+
+def _altitude(func, *args):
+    try:
+        return func(*args)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+@pytest.mark.parametrize('cal', CALS)
+@pytest.mark.parametrize('press0', BASE_PRESSURES)
+def test_palt3_table(press0, cal):
+    table = prodata.palt3_table(press0, cal)
+
+    assert len(table) == 256
+    assert table == tuple(prodata.palt3(press, press0, cal) for press in range(256))
+
+
+@pytest.mark.parametrize('cal', CALS[1:])
+@pytest.mark.parametrize('press_0', BASE_PRESSURES)
+def test_pressure_alt_table(press_0, cal):
+    table = proreduce.pressure_alt_table(press_0, cal)
+
+    assert len(table) == 256
+    assert table == tuple(_altitude(proreduce.pressure_alt, press, press_0, cal) for press in range(256))
+
+
+def test_tables_follow_the_calibration():
+    cal = {'GainBP': 1.0, 'OffBP': 23.3}
+    site = proreduce.pressure_alt_table(236, cal)
+    biba = prodata.palt3_table(236, cal)
+
+    cal['OffBP'] = 13.6
+    assert proreduce.pressure_alt_table(236, cal) != site
+    assert prodata.palt3_table(236, cal) != biba
+    assert proreduce.pressure_alt_table(236, cal)[200] == proreduce.pressure_alt(200, 236, cal)
+    assert prodata.palt3_table(236, cal)[200] == prodata.palt3(200, 236, cal)